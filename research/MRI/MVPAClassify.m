@@ -40,6 +40,12 @@ function res = MVPAClassify(cPathData,cTarget,kChunk,varargin)
 %										uneven mask sizes
 %		mask_balancer_count:	(25) the number of bootstrap iterations to
 %								perform for each mask when balancing (see above)
+%		mask_union:				(false) true to load only the voxels in the union
+%								of all the masks, instead of the whole brain.
+%								this keeps peak memory proportional to the mask
+%								voxels when many masks are analyzed. note that
+%								mask_bootstrap_subset indices then refer to the
+%								union voxels.
 %		partitioner:			(1) the partitioner to use. one of the
 %								following:
 %									n:	use NFoldPartitioner, leaving n folds
@@ -53,12 +59,46 @@ function res = MVPAClassify(cPathData,cTarget,kChunk,varargin)
 %								LinearCSVMC, SMLR, RbfCSVMC. classifiers can
 %								also specify parameters
 %								(e.g. 'LinearCSVMC(C=-0.5)').
+%		nested_path:			(false) for nested classifier selection, true
+%								to train the classifiers on each inner fold
+%								as a regularization path, with each one
+%								starting from the solution of the previous
+%								one. this only applies if the classifiers
+%								are all SMLR or all the same scikit-learn
+%								estimator with a warm_start parameter, and
+%								they only differ in one parameter (e.g.
+%								{'SMLR(lm=10)','SMLR(lm=1)','SMLR(lm=0.1)'}).
+%								the classifiers are trained in the order
+%								given. this is faster, but the warm-started
+%								fits converge to slightly different solutions
+%								than independent fits, so the inner-fold
+%								accuracies (and, when candidates perform
+%								similarly, the selected classifier) can differ
+%								from those with nested_path set to false.
 %		allway:					(true) true to perform an all-way classification
 %		twoway:					(false) true to perform every pairwise
 %								classification
 %		permutations:			(false) the number of permutations to perform
 %								during Monte Carlo testing. set to false to skip
 %								permutation testing.
+%		permutation_stop:		('none') stop drawing permutations early once
+%								the p-value is clearly resolved. one of the
+%								following:
+%									'none': always perform <permutations>
+%										permutations
+%									'besag': Besag-Clifford sequential test.
+%										stop once <permutation_h> permuted
+%										accuracies at least as high as the
+%										observed accuracy have been found
+%									'alpha': stop once the
+%										<permutation_confidence> confidence
+%										interval of the p-value lies entirely
+%										above or below <permutation_alpha>
+%								the number of permutations performed is saved
+%								in accuracy.permutation_count.
+%		permutation_h:			(10) see <permutation_stop>
+%		permutation_alpha:		(0.05) see <permutation_stop>
+%		permutation_confidence:	(0.99) see <permutation_stop>
 %		sensitivities:			(false) true to save the L1-normed
 %								classification sensitivities. note that
 %								sensivities cannot be saved if nested classifier
@@ -80,6 +120,13 @@ function res = MVPAClassify(cPathData,cTarget,kChunk,varargin)
 %		match_include_blank:	(true) true to include blank samples in the
 %								feature matching step of matched dataset
 %								cross-classifications
+%		match_incremental:		(false) true to compute feature matching
+%								correlations from per-chunk/target sums that
+%								are updated as chunks enter and leave the
+%								training folds. this avoids recomputing the
+%								correlations for every fold, but stores an
+%								nFeature x nFeature matrix for each
+%								chunk/target pair.
 %		dcclassify:				(false) true to perform a directed connectivity
 %								classification, in which directed connectivity
 %								patterns are constructed for each target and
@@ -88,7 +135,20 @@ function res = MVPAClassify(cPathData,cTarget,kChunk,varargin)
 %								dataset 2. the classification is performed on
 %								these patterns.
 %		dcclassify_lags:		(1) the number of lags to use in directed
-%								connectivity classifications
+%								connectivity classifications. an array of lag
+%								orders computes the patterns for each lag order
+%								in a single pass, and performs a separate
+%								classification for each one (stored in fields
+%								lag<n>).
+%		dcclassify_lag_select:	('none') if an array of lag orders is
+%								specified, 'aic' or 'bic' to instead choose the
+%								lag order of each feature pair according to
+%								that information criterion, and perform a single
+%								classification
+%		dcclassify_memmap:		(false) true to stream directed connectivity
+%								patterns into a float32 array backed by a
+%								temporary file rather than holding them in
+%								memory (for large pairs of masks)
 %		selection:				(1) the number or fraction of features to select
 %								for classification, based on a one-way ANOVA. if
 %								a number less than one is passed, it is
@@ -111,6 +171,12 @@ function res = MVPAClassify(cPathData,cTarget,kChunk,varargin)
 %								unbalanced targets. set to false to skip target
 %								balancing. this is ignored for directed
 %								connectivity classifications.
+%		seed:					(0) the random seed. every random draw (mask
+%								bootstrap subsets, target balancing,
+%								permutations, etc.) comes from a stream derived
+%								from this seed and the task it belongs to, so
+%								results are reproducible and don't depend on
+%								which tasks run in parallel.
 %		mean_control:			(false) true to perform a control classification
 %								on the mean pattern value of each target and
 %								chunk
@@ -122,6 +188,31 @@ function res = MVPAClassify(cPathData,cTarget,kChunk,varargin)
 %												them
 %									'feature':	remove feature dimensions in
 %												which any sample has a NaN
+%		cache_dir:				(<none>) a directory in which to cache masked,
+%								preprocessed datasets, so that reanalyses that
+%								only change e.g. the classifier or partitioner
+%								don't repeat the preprocessing
+%		cache_size:				(10240) the maximum size of the dataset cache,
+%								in MB. least recently used datasets are evicted
+%								once the cache grows beyond this size.
+%		checkpoint:				(true) true to record each finished
+%								classification (allway, each twoway pair, mean
+%								control, etc.) in a <name>.checkpoint.sqlite
+%								file next to the results, so that rerunning an
+%								interrupted analysis with <force_each> set to
+%								false only performs the missing
+%								classifications. the file is deleted once the
+%								analysis finishes. checkpoints are only
+%								recorded if <force_each> is false, since
+%								otherwise they would never be read.
+%		result_format:			('mat') the format of the intermediate result
+%								file saved for each mask. either 'mat' or
+%								'hdf5' (requires h5py). HDF5 results are
+%								saved with chunked, compressed datasets and
+%								their large arrays are only read when they
+%								are needed, which makes reusing existing mask
+%								results faster. the final result file is
+%								always a .mat file.
 %		array_to_file:			(false) true to save arrays like sensitivity
 %								maps and selected voxels to file instead of
 %								returning them in the results struct
@@ -166,6 +257,23 @@ function res = MVPAClassify(cPathData,cTarget,kChunk,varargin)
 %								models will be meaned before correlating
 %								with the group mean confusion matrix.
 %		cores:					(1) the number of processor cores to use
+%		cores_python:			(1) the number of processor cores that each
+%								python classification process uses to classify
+%								masks (or, for a single mask, twoway target
+%								pairs) in parallel. note that the total number
+%								of processes is <cores> x <cores_python>.
+%		load_slots:				(1) the number of python processes that may
+%								load data at the same time
+%		server:					(<none>) the job directory of a running
+%								MVPAClassify.py server (started with 'python
+%								MVPAClassify.py --server <dir_job> [<workers>]').
+%								if specified, classifications are submitted to
+%								the server instead of starting a new python
+%								process for each one, which avoids paying the
+%								python import cost for every classification.
+%		server_timeout:			(60) the number of seconds to wait for a
+%								heartbeat from the server before giving up on
+%								a submitted job
 %		force:					(true) true to force the analysis to run even if
 %								the output results files already exist
 %		force_each:				(<force>) true to force each mask analysis to
@@ -189,7 +297,7 @@ function res = MVPAClassify(cPathData,cTarget,kChunk,varargin)
 % 	res	- if <combine> is selected, then a structtree of analysis results.
 %		  otherwise, a cell of result structs.
 % 
-% Updated: 2015-05-01
+% Updated: 2026-10-18
 % Copyright 2015 Alex Schlegel (schlegel@gmail.com).  This work is licensed
 % under a Creative Commons Attribution-NonCommercial-ShareAlike 3.0 Unported
 % License.
@@ -202,27 +310,41 @@ function res = MVPAClassify(cPathData,cTarget,kChunk,varargin)
 			'mask_name'				, {}				, ...
 			'mask_balancer'			, 'none'			, ...
 			'mask_balancer_count'	, 25				, ...
+			'mask_union'			, false				, ...
 			'partitioner'			, 1					, ...
 			'classifier'			, 'LinearCSVMC'		, ...
+			'nested_path'			, false				, ...
 			'allway'				, true				, ...
 			'twoway'				, false				, ...
 			'permutations'			, false				, ...
+			'permutation_stop'		, 'none'			, ...
+			'permutation_h'			, 10				, ...
+			'permutation_alpha'		, 0.05				, ...
+			'permutation_confidence', 0.99				, ...
 			'sensitivities'			, false				, ...
 			'average'				, false				, ...
 			'spatiotemporal'		, false				, ...
 			'matchedcrossclassify'	, false				, ...
 			'match_features'		, false				, ...
 			'match_include_blank'	, true				, ...
+			'match_incremental'		, false				, ...
 			'dcclassify'			, false				, ...
 			'dcclassify_lags'		, 1					, ...
+			'dcclassify_lag_select'	, 'none'			, ...
+			'dcclassify_memmap'		, false				, ...
 			'selection'				, 1					, ...
 			'save_selected'			, false				, ...
 			'target_subset'			, {}				, ...
 			'target_blank'			, NaN				, ...
 			'zscore'				, 'chunks'			, ...
 			'target_balancer'		, 10				, ...
+			'seed'					, 0					, ...
 			'mean_control'			, false				, ...
 			'nan_remove'			, 'none'			, ...
+			'cache_dir'				, []				, ...
+			'cache_size'			, 10240				, ...
+			'checkpoint'			, true				, ...
+			'result_format'			, 'mat'				, ...
 			'array_to_file'			, false				, ...
 			'combine'				, true				, ...
 			'stats'					, []				, ...
@@ -230,6 +352,10 @@ function res = MVPAClassify(cPathData,cTarget,kChunk,varargin)
 			'confcorr_method'		, 'subjectjk'		, ...
 			'matched_confmodels'	, false				, ...
 			'cores'					, 1					, ...
+			'cores_python'			, 1					, ...
+			'server'				, []				, ...
+			'server_timeout'		, 60				, ...
+			'load_slots'			, 1					, ...
 			'force'					, true				, ...
 			'force_each'			, []				, ...
 			'run'					, true				, ...
@@ -247,6 +373,9 @@ function res = MVPAClassify(cPathData,cTarget,kChunk,varargin)
 	%make sure we got proper option values
 		opt.mask_balancer	= CheckInput(opt.mask_balancer,'mask_balancer',{'none','bootstrap','erode'});
 		opt.nan_remove		= CheckInput(opt.nan_remove,'nan_remove',{'none','sample','feature'});
+		opt.dcclassify_lag_select	= CheckInput(opt.dcclassify_lag_select,'dcclassify_lag_select',{'none','aic','bic'});
+		opt.permutation_stop	= CheckInput(opt.permutation_stop,'permutation_stop',{'none','besag','alpha'});
+		opt.result_format	= CheckInput(opt.result_format,'result_format',{'mat','hdf5'});
 		opt.confcorr_method	= CheckInput(opt.confcorr_method,'confusion correlation method',{'group','subject','subjectjk'});
 		
 		assert(opt.selection>=0 && (opt.selection<1 || isint(opt.selection)),'uninterpretable selection parameter.');
@@ -319,6 +448,10 @@ function res = MVPAClassify(cPathData,cTarget,kChunk,varargin)
 	%get rid of options that only apply here
 		param	= rmfield(opt,{'opt_extra','isoptstruct','combine','stats','confusion_model','confcorr_method','cores','type','debug_multitask'});
 	
+	%the python script's own cores parameter
+		param.cores	= param.cores_python;
+		param		= rmfield(param,'cores_python');
+	
 	%switcheroo to one param struct per analysis
 		param	= opt2cell(param);
 		param	= num2cell(struct(param{:}));
@@ -430,9 +563,15 @@ function res = ClassifyOne(param,kTarget,kChunk)
 	end
 	
 	%run the python script
-		L.Print('calling python classification script','all');
-		[ec,str]	= CallProcess('python',{param.path_script param.path_param});
-		L.Print('python classification script finished','all');
+		if isempty(param.server)
+			L.Print('calling python classification script','all');
+			[ec,str]	= CallProcess('python',{param.path_script param.path_param});
+			L.Print('python classification script finished','all');
+		else
+			L.Print(sprintf('submitting job to python server at %s',param.server),'all');
+			[ec,str]	= SubmitServerJob(param);
+			L.Print('python server job finished','all');
+		end
 		
 		if ec~=0
 			strError	= sprintf('python script error: %s',str{1});
@@ -447,6 +586,68 @@ function res = ClassifyOne(param,kTarget,kChunk)
 	%load the results
 		res	= LoadResult(param);
 %------------------------------------------------------------------------------%
+function [ec,str] = SubmitServerJob(param)
+%submit the classification to an MVPAClassify.py server and wait for it to
+%finish
+	strJob		= sprintf('%s-%d',param.name,round(nowms));
+	strPathJob	= PathUnsplit(param.server,strJob,'job');
+	strPathTmp	= PathUnsplit(param.server,strJob,'tmp');
+	strPathDone	= PathUnsplit(param.server,strJob,'done');
+	
+	%write the job file atomically so the server never sees a partial file
+		fput(param.path_param,strPathTmp);
+		movefile(strPathTmp,strPathJob);
+	
+	%wait for the server to report back. give up if the server's heartbeat
+	%stops changing (e.g. it crashed or was never started).
+		strPathHeartbeat	= PathUnsplit(param.server,'heartbeat');
+		strHeartbeat		= '';
+		tHeartbeat			= tic;
+		
+		while ~FileExists(strPathDone)
+			if FileExists(strPathHeartbeat)
+				strHeartbeatCur	= fget(strPathHeartbeat);
+				
+				if ~isequal(strHeartbeatCur,strHeartbeat)
+					strHeartbeat	= strHeartbeatCur;
+					tHeartbeat		= tic;
+				end
+			end
+			
+			if toc(tHeartbeat) > param.server_timeout
+				DeleteServerJobFiles(param,strJob);
+				
+				ec	= 1;
+				str	= {sprintf('no heartbeat from the python server at %s for %d seconds. is the server running?',param.server,param.server_timeout)};
+				return;
+			end
+			
+			pause(0.05);
+		end
+		
+		report	= json.load(strPathDone);
+		
+		DeleteServerJobFiles(param,strJob);
+	
+	ec	= ~report.success;
+	if report.success
+		str	= {''};
+	else
+		str	= {report.error};
+	end
+%------------------------------------------------------------------------------%
+function DeleteServerJobFiles(param,strJob)
+%delete the files in the server's job directory that belong to a job
+	cExt	= {'job' 'tmp' 'run' 'done' 'log'};
+	
+	for kE=1:numel(cExt)
+		strPath	= PathUnsplit(param.server,strJob,cExt{kE});
+		
+		if FileExists(strPath)
+			delete(strPath);
+		end
+	end
+%------------------------------------------------------------------------------%
 function param = ParseMaskBalancer(param)
 	if isequal(param.mask_balancer,'erode')
 	%erode the masks to equal size
@@ -8,16 +8,35 @@ with warnings.catch_warnings():
 	import time
 	import json
 	import random
+	import glob
+	import traceback
+	import fcntl
+	import hashlib
+	import shutil
+	import tempfile
+	import cPickle as pickle
+	import sqlite3
+	import multiprocessing
 	
 	from abc import ABCMeta, abstractmethod
 	
 	import numpy as np
 	import scipy.io
+	import scipy.special
 	import scipy.stats as spstats
 	
 	from sklearn.metrics.pairwise import pairwise_distances
-	from sklearn.utils.linear_assignment_ import linear_assignment
-	from sklearn import linear_model
+	
+	try:
+		import h5py
+	except ImportError:
+		h5py = None
+	
+	try:
+		from scipy.optimize import linear_sum_assignment
+	except ImportError:
+		from sklearn.utils.linear_assignment_ import linear_assignment
+		linear_sum_assignment = None
 	
 	from mvpa2.suite import *
 
@@ -31,6 +50,24 @@ DBG_PREFIX = [None, None, 'warning', 'error']
 
 dbg = 'all'
 
+#the task being run by parallel_map. it is stored here before the worker
+#processes are forked so the workers inherit it instead of it being pickled.
+_parallel_task = None
+_parallel_worker = False
+
+#feature matching plans that have already been calculated, keyed by a hash of
+#the data they were calculated from
+_feature_match_cache = {}
+FEATURE_MATCH_CACHE_SIZE = 1024
+
+#minimum number of permutations to evaluate between checks for stopping a
+#sequential permutation test
+PERMUTATION_ROUND_SIZE = 20
+
+#arrays in HDF5 mask results with at least this many elements are only read
+#from the file once they are needed
+HDF5_LAZY_SIZE = 10000
+
 def rec2dict(rec):
 	if isinstance(rec,np.ndarray):
 		if rec.shape==(1,1) and isinstance(rec[0,0].dtype.names,tuple):
@@ -45,12 +82,90 @@ def rec2dict(rec):
 				rec = str(rec[0])
 			else:
 				raise Exception('damn')
-		elif len(rec.shape)==2:
-			for (x,y), res in np.ndenumerate(rec):
-				rec[x,y] = rec2dict(rec[x,y])
+		elif len(rec.shape)==2 and rec.dtype == np.object:  # only cells can hold structs
+			for idx in np.ndindex(rec.shape):
+				rec[idx] = rec2dict(rec[idx])
 	
 	return rec
 
+def save_hdf5(group, name, x):
+	"""save a result value to an HDF5 group. numeric arrays become chunked,
+	compressed datasets. everything else is stored so that load_hdf5 gets back
+	the same python types."""
+	if isinstance(x, dict):
+		sub = group.create_group(name, track_order=True)
+		sub.attrs['type'] = 'dict'
+		
+		for key in x:
+			save_hdf5(sub, str(key), x[key])
+	elif isinstance(x, (list, tuple)):
+		sub = group.create_group(name)
+		sub.attrs['type'] = type(x).__name__
+		sub.attrs['length'] = len(x)
+		
+		for idx, val in enumerate(x):
+			save_hdf5(sub, str(idx), val)
+	elif isinstance(x, np.ndarray) and x.dtype == np.object:
+		sub = group.create_group(name)
+		sub.attrs['type'] = 'cell'
+		sub.attrs['shape'] = x.shape
+		
+		for idx, val in enumerate(x.flat):
+			save_hdf5(sub, str(idx), val)
+	elif isinstance(x, np.ndarray):
+		if x.size > 1:
+			ds = group.create_dataset(name, data=x, chunks=True, compression='gzip')
+		else:
+			ds = group.create_dataset(name, data=x)
+		ds.attrs['type'] = 'array'
+	elif x is None:
+		group.create_group(name).attrs['type'] = 'none'
+	elif isinstance(x, str):
+		ds = group.create_dataset(name, data=x, dtype=h5py.special_dtype(vlen=str))
+		ds.attrs['type'] = 'str'
+	elif isinstance(x, np.generic):
+		ds = group.create_dataset(name, data=x)
+		ds.attrs['type'] = 'numpy'
+	else:
+		ds = group.create_dataset(name, data=x)
+		ds.attrs['type'] = type(x).__name__
+
+def load_hdf5(obj, lazy=False):
+	"""load a result value saved by save_hdf5. if lazy is True, large arrays
+	are returned as HDF5Arrays that read the array when called."""
+	kind = obj.attrs['type']
+	
+	if kind == 'dict':
+		x = {}
+		
+		for key in obj:
+			x[str(key)] = load_hdf5(obj[key], lazy=lazy)
+	elif kind in ['list', 'tuple']:
+		x = [load_hdf5(obj[str(idx)], lazy=lazy) for idx in range(obj.attrs['length'])]
+		
+		if kind == 'tuple':
+			x = tuple(x)
+	elif kind == 'cell':
+		x = np.empty(tuple(obj.attrs['shape']), dtype=np.object)
+		
+		for idx in range(x.size):
+			x[np.unravel_index(idx, x.shape)] = load_hdf5(obj[str(idx)], lazy=lazy)
+	elif kind == 'array':
+		if lazy and obj.size >= HDF5_LAZY_SIZE:
+			x = HDF5Array(obj.file.filename, obj.name)
+		else:
+			x = obj[...]
+	elif kind == 'none':
+		x = None
+	elif kind == 'str':
+		x = str(obj[()])
+	elif kind == 'numpy':
+		x = obj[()]
+	else:
+		x = {'int': int, 'long': long, 'float': float, 'bool': bool}[kind](obj[()])
+	
+	return x
+
 def force_list(x, count=None):
 	"""force x to be a list of the specified size"""
 	if not isinstance(x, list):
@@ -69,32 +184,6 @@ def force_list(x, count=None):
 			
 	return x
 
-def flip_dict(x):
-	"""flip an NxN array of dicts to be a dict of NxN arrays"""
-	shp = np.shape(x)
-	y = x[0,1].copy()
-	
-	for key in y:
-		val = y[key]
-		
-		if np.isscalar(val) and not isinstance(val, str):
-			dtype = np.float64
-		else:
-			dtype = np.object
-		
-		y[key] = np.ndarray(shp, dtype=dtype)
-			
-		for (i,j), d in np.ndenumerate(x):
-			if isinstance(d, dict):
-				y[key][i,j] = d[key]
-			else:
-				y[key][i,j] = np.nan
-		
-		if isinstance(val, dict):
-			y[key] = flip_dict(y[key])
-	
-	return y
-
 def has_len(x):
 	"""test whether a variable has a length"""
 	try:
@@ -117,6 +206,49 @@ def status(msg, indent=0, debug='info', show=True):
 		str_prefix = '%s: ' % (str_prefix)  if str_prefix else ''
 		
 		print '%s %s- %s%s' % (str_time, str_indent, str_prefix, msg)
+		
+		#flush so output from worker processes isn't lost or garbled
+		sys.stdout.flush()
+
+def _parallel_init():
+	"""initialize a parallel_map worker process"""
+	global _parallel_worker
+	
+	_parallel_worker = True
+
+def _parallel_call(idx):
+	"""call the parallel_map task for one argument"""
+	fcn, args = _parallel_task
+	
+	return fcn(args[idx])
+
+def parallel_map(fcn, args, cores=1):
+	"""map fcn over a list of args, using a pool of forked worker processes if
+	cores > 1. fcn and args are inherited by the workers rather than pickled,
+	so e.g. datasets loaded before calling are shared copy-on-write and fcn
+	can be a closure. only the return values are pickled. calls made from
+	within a worker run serially."""
+	global _parallel_task
+	
+	cores = min(cores, len(args))
+	if cores <= 1 or _parallel_worker:
+		return [fcn(arg) for arg in args]
+	
+	_parallel_task = (fcn, args)
+	
+	sys.stdout.flush()
+	pool = multiprocessing.Pool(cores, initializer=_parallel_init)
+	try:
+		result = pool.map(_parallel_call, range(len(args)), chunksize=1)
+		pool.close()
+	except:
+		pool.terminate()
+		raise
+	finally:
+		pool.join()
+		_parallel_task = None
+	
+	return result
 
 def divides(x, d):
 	"""does d divide x?"""
@@ -174,10 +306,55 @@ def add_file_suffix(file_path, suffix):
 	
 	return os.path.join(path_dir,'%s%s%s' % (file_pre, suffix, file_ext))
 
+def memmap_empty(shape, dtype=np.float64):
+	"""create an empty array backed by a temporary file. the file is unlinked
+	right away, so it disappears once the array is released."""
+	fd, path = tempfile.mkstemp(prefix='mvpaclassify-', suffix='.npy')
+	os.close(fd)
+	
+	try:
+		x = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+	finally:
+		os.remove(path)
+	
+	return x
+
+def memmap_array(x):
+	"""move an array into a temporary file and return a copy-on-write memory
+	map of it. the file is unlinked right away, so it disappears once the map
+	is released, and forked processes share its pages."""
+	fd, path = tempfile.mkstemp(prefix='mvpaclassify-', suffix='.npy')
+	os.close(fd)
+	
+	try:
+		np.save(path, x)
+		x = np.load(path, mmap_mode='c')
+	finally:
+		os.remove(path)
+	
+	return x
+
+def get_seed(param, *key):
+	"""get a random seed that is determined entirely by param['seed'] and a
+	json-serializable key identifying the task that uses it, so random draws
+	don't depend on what else was drawn before or in which process the task
+	runs"""
+	return int(hashlib.sha1(json.dumps([param['seed']] + list(key))).hexdigest()[:8], 16)
+
+def get_rng(param, *key):
+	"""get a random number generator seeded by get_seed"""
+	return np.random.RandomState(get_seed(param, *key))
+
+def seed_rngs(seed):
+	"""seed the global numpy and python random number generators, which are
+	used by PyMVPA (e.g. Balancer, SMLR)"""
+	np.random.seed(seed)
+	random.seed(seed)
+
 def map2nifti_fixed(ds, data=None):
 	"""when map2niftiing spatiotemporal datasets, we get extra zero-filled
 	samples. also make non-masked values NaN."""
-	if data == None:
+	if data is None:
 		data = ds
 	data_like = data.samples if isinstance(data, Dataset) else data
 	
@@ -206,6 +383,11 @@ def map2nifti_fixed(ds, data=None):
 def save_dataset(param, array_type, ds, data=None):
 	nii = map2nifti_fixed(ds, data=data)
 	
+	return save_nifti(param, array_type, nii)
+
+def save_nifti(param, array_type, nii):
+	"""save a mapped array to file or return its data, depending on
+	param['array_to_file']"""
 	if param['array_to_file']:
 		path_prefix = os.path.splitext(param['path_result'])[0]
 		
@@ -227,6 +409,50 @@ def save_dataset(param, array_type, ds, data=None):
 		return nii.get_data()
 
 
+def get_selection_counts(result):
+	"""find the SelectionCounts in a result, as a list of (parent, key)
+	tuples"""
+	counts = []
+	
+	if isinstance(result, dict):
+		items = result.iteritems()
+	elif isinstance(result, np.ndarray) and result.dtype == np.object:
+		items = np.ndenumerate(result)
+	else:
+		items = []
+	
+	for key, val in items:
+		if isinstance(val, SelectionCount):
+			counts.append((result, key))
+		else:
+			counts.extend(get_selection_counts(val))
+	
+	return counts
+
+def export_selected(param, ds, result):
+	"""map the selection counts recorded in result back into the mask's space
+	as the fraction of selections that included each voxel. the counts of all
+	of the mask's classifications are mapped at once."""
+	counts = get_selection_counts(result)
+	if len(counts) == 0:
+		return
+	
+	records = [parent[key] for parent, key in counts]
+	
+	selected = ds[np.zeros(len(records), dtype=int)].copy()
+	selected.samples = np.array([r.count for r in records], dtype=ds.samples.dtype)
+	selected.samples /= np.array([[r.selection_count] for r in records], dtype=ds.samples.dtype)
+	
+	nii = map2nifti_fixed(selected)
+	data = nii.get_data()
+	
+	classification_name = param['classification_name']
+	for idx, ((parent, key), record) in enumerate(zip(counts, records)):
+		param['classification_name'] = record.name
+		nii_record = nii.__class__(data[:,:,:,idx:idx+1], nii.affine, nii.header)
+		parent[key] = save_nifti(param, 'selected', nii_record)
+	param['classification_name'] = classification_name
+
 def process_sensitivities(param, ds, sense):
 	result = {}
 	
@@ -243,39 +469,116 @@ def process_sensitivities(param, ds, sense):
 	
 	return result
 
-def parse_twoway(result, key=None):
-	"""change the NxN ndarray of dicts to a dict of NxN arrays"""
-	if key == 'twoway':
-		result = flip_dict(result)
+class TwowayResult(dict):
+	"""the results of a set of twoway classifications, stored by column rather
+	than as an NxN array of dicts. each value has one row per classified pair
+	(in the order of the True elements of cells). numeric values are stacked
+	into typed arrays so they can be averaged and summarized in one go, other
+	values are kept in lists, and nested dicts become nested TwowayResults."""
+	cells = None
+	
+	def flip(self):
+		"""convert to a dict of NxN arrays (the layout that gets saved)"""
+		result = {}
+		
+		idx = zip(*np.nonzero(self.cells))
+		
+		for key in self:
+			val = self[key]
+			
+			if isinstance(val, TwowayResult):
+				result[key] = val.flip()
+				continue
+			
+			if isinstance(val, np.ndarray):
+				is_scalar = val.ndim == 1
+			else:
+				is_scalar = np.isscalar(val[0]) and not isinstance(val[0], str)
+			
+			if is_scalar:
+				result[key] = np.full(self.cells.shape, np.nan)
+				result[key][self.cells] = val
+			else:
+				result[key] = np.full(self.cells.shape, np.nan, dtype=np.object)
+				
+				for ij, v in zip(idx, val):
+					result[key][ij] = v
+		
+		return result
+	
+	def _get_column(self, values):
+		"""combine the values from each row into a column"""
+		val = values[0]
+		
+		if isinstance(val, dict):
+			return TwowayResult(self.cells, values)
+		elif all([isinstance(v, np.float64) for v in values]):
+			return np.array(values)
+		elif all([isinstance(v, np.ndarray) and v.dtype.kind in 'biuf' and v.ndim > 0 and v.shape == val.shape for v in values]):
+			return np.array(values, dtype=np.float64)
+		else:
+			return list(values)
+	
+	def __init__(self, cells, rows=None, *args, **kwargs):
+		dict.__init__(self, *args, **kwargs)
+		
+		self.cells = cells
+		
+		if rows:
+			for key in rows[0]:
+				self[key] = self._get_column([row[key] for row in rows])
+
+def parse_twoway(result):
+	"""change the TwowayResults to dicts of NxN arrays"""
+	if isinstance(result, TwowayResult):
+		result = result.flip()
 	elif isinstance(result, dict):
 		for key in result:
-			result[key] = parse_twoway(result[key], key=key)
+			result[key] = parse_twoway(result[key])
 	
 	return result
 
+def average_value(key, values):
+	"""average a set of bootstrapped values"""
+	val = values[0]
+	
+	if key == 'mask_bootstrap_subset':  # keep each bootstrap's voxels
+		return list(values)
+	elif isinstance(val, dict):
+		return average_values(values)
+	elif isinstance(val, np.float64):
+		return np.nanmean(values, axis=0)
+	elif isinstance(val, np.ndarray) and not val.dtype == np.object:
+		return np.nanmean(values, axis=0)
+	elif key != 'target':
+		values = list(values)
+		
+		#make sure we get a cell-array back in MATLAB
+		if isinstance(val, str):
+			values = np.array(values, dtype=np.object)
+		
+		return values
+	else:
+		return val
+
 def average_values(result):
 	"""average the results of bootstrapping"""
 	result_avg = result[0]
 	
-	if isinstance(result_avg,dict):
+	if isinstance(result_avg, TwowayResult):
 		for key in result_avg:
 			val = result_avg[key]
+			values = [r[key] for r in result]
 			
-			if isinstance(val,dict):
-				result_avg[key] = average_values([r[key] for r in result])
-			elif isinstance(val, np.float64):
-				result_avg[key] = np.nanmean([r[key] for r in result], axis=0)
-			elif key == 'twoway':
-				for (x,y), res in np.ndenumerate(val):
-					result_avg[key][x,y] = average_values([r[key][x,y] for r in result])
-			elif isinstance(val, np.ndarray) and not val.dtype == np.object:
-				result_avg[key] = np.nanmean([r[key] for r in result], axis=0)
+			if isinstance(val, TwowayResult):
+				result_avg[key] = average_values(values)
+			elif isinstance(val, np.ndarray):  # typed columns average in one go
+				result_avg[key] = np.nanmean(values, axis=0)
 			elif key != 'target':
-				result_avg[key] = [r[key] for r in result]
-				
-				#make sure we get a cell-array back in MATLAB
-				if isinstance(val, str):
-					result_avg[key] = np.array(result_avg[key],dtype=np.object)
+				result_avg[key] = [average_value(key, cell) for cell in zip(*values)]
+	elif isinstance(result_avg, dict):
+		for key in result_avg:
+			result_avg[key] = average_value(key, [r[key] for r in result])
 	
 	return result_avg
 
@@ -287,69 +590,143 @@ def parse_values(result, key=None):
 	if isinstance(result, dict):  # result dict
 		for key in result:
 			result[key] = parse_values(result[key], key=key)
+	elif isinstance(result, HDF5Array):  # arrays that haven't been read yet
+		result = parse_values(result(), key=key)
 	elif isinstance(result, list) and isinstance(result[0],dict):  # bootstrapped results need to be averaged
 		result = average_values([parse_values(res) for res in result])
 	elif key == 'twoway':  # twoway classifications
-		for (x,y), res in np.ndenumerate(result):
-			result[x,y] = parse_values(res)
+		cells = np.reshape([isinstance(res, dict) for res in result.flat], result.shape)
+		result = TwowayResult(cells, [parse_values(res) for res in result[cells]])
 	elif isinstance(result, np.ndarray) and not result.dtype == np.object:  # make everything double precision
 		result = result.astype(np.float64)
 	
 	return result
 
 def acc_stats(accuracies, target_count=None):
+	"""calculate accuracy statistics for a set of classifications at once
+	
+	Parameters
+	----------
+	accuracies : array
+	  a classifications x folds x ... array of accuracies
+	target_count : int, optional
+	  the number of targets in each classification
+	
+	Returns
+	-------
+	acc : dict
+	  the statistics, each with one value per classification
+	"""
+	accuracies_flat = np.reshape(accuracies, (len(accuracies), -1))
+	
 	acc = {
 		'all': accuracies,
-		'mean': np.mean(accuracies),
-		'se': np.asscalar(spstats.sem(accuracies))
+		'mean': np.mean(accuracies_flat, axis=1),
+		'se': spstats.sem(accuracies_flat, axis=1)
 	}
 	
 	if target_count is not None:
 		#one-tailed binomial test
-		N = len(accuracies)
+		N = accuracies.shape[1]
 		X = np.round(acc['mean'] * N)
-		acc['chance'] = 1.0/target_count
+		acc['chance'] = np.full(len(accuracies), 1.0/target_count)
 		
 		acc['binomial_p'] = spstats.binom.sf(X-1, N, acc['chance'])
 	
 	return acc
 
-def compute_accuracy_stats(result, target_count=None, key=None):
-	"""calculate some statistics for the classification accuracies"""
-	if key == 'accuracy' and 'all' in result:
-		result = result['all']
-		
-		if isinstance(result, np.ndarray) and result.dtype == np.object:
-			for (x,y), val in np.ndenumerate(result):
-				if not np.isscalar(result[x,y]) or not np.isnan(result[x,y]):
-					result[x,y] = acc_stats(result[x,y], target_count)
-			
-			result = flip_dict(result)
-		else:
-			result = acc_stats(result, target_count)
-	elif isinstance(result, dict):
+def get_accuracy_results(result, target_count=None):
+	"""find the accuracy results that need statistics, as a list of
+	(parent, key, target_count) tuples"""
+	accuracies = []
+	
+	if isinstance(result, dict):
 		if 'target' in result:
-			if np.ndim(result['target']) == 2 and result['target'].shape[1]!=1:
-				target_count = len(result['target'][0,-1])
+			if isinstance(result, TwowayResult):
+				target_count = len(result['target'][0])
 			else:
 				target_count = len(result['target'])
 		else:
 			target_count = None
-			
+		
 		for key in result:
-			result[key] = compute_accuracy_stats(result[key], target_count=target_count, key=key)
+			if key == 'accuracy' and 'all' in result[key]:
+				accuracies.append((result, key, target_count))
+			else:
+				accuracies.extend(get_accuracy_results(result[key], target_count=target_count))
+	
+	return accuracies
+
+def compute_accuracy_stats(result):
+	"""calculate some statistics for the classification accuracies. the
+	accuracies of every classification (all masks and twoway pairs) with the
+	same number of folds and targets are summarized together."""
+	accuracies = get_accuracy_results(result)
+	
+	#group the accuracies into stacks of rows. twoway results contribute all
+	#of their pairs at once unless the pairs have different numbers of folds.
+	groups = {}
+	row_counts = []
+	for idx, (parent, key, target_count) in enumerate(accuracies):
+		acc = parent[key]['all']
+		
+		if not isinstance(parent[key], TwowayResult):
+			stacks = [([0], np.asarray(acc)[np.newaxis])]
+			row_counts.append(1)
+		elif isinstance(acc, np.ndarray):
+			stacks = [(np.arange(len(acc)), acc)]
+			row_counts.append(len(acc))
+		else:
+			stacks = [([row], np.asarray(a)[np.newaxis]) for row, a in enumerate(acc)]
+			row_counts.append(len(acc))
+		
+		for rows, stack in stacks:
+			groups.setdefault((stack.shape[1:], target_count), []).append((idx, rows, stack))
+	
+	#compute the statistics of each group in one go
+	stats = [None]*len(accuracies)
+	for (shape, target_count), group in groups.iteritems():
+		acc = acc_stats(np.concatenate([stack for _, _, stack in group]), target_count)
+		
+		start = 0
+		for idx, rows, stack in group:
+			if stats[idx] is None:
+				stats[idx] = [(k, None if k == 'all' else np.empty(row_counts[idx])) for k in acc]
+			
+			end = start + len(stack)
+			for k, v in stats[idx]:
+				if v is not None:
+					v[rows] = acc[k][start:end]
+			start = end
+	
+	#replace the accuracies with their statistics
+	for (parent, key, _), stat in zip(accuracies, stats):
+		acc = parent[key]
+		
+		if isinstance(acc, TwowayResult):
+			acc_result = TwowayResult(acc.cells)
+			
+			for k, v in stat:
+				acc_result[k] = acc['all'] if v is None else v
+		else:
+			acc_result = {}
+			
+			for k, v in stat:
+				acc_result[k] = acc['all'] if v is None else v[0]
+		
+		parent[key] = acc_result
 	
 	return result
 
 def parse_results(param, result):
 	result = parse_values(result)
-	result = parse_twoway(result)
 	result = compute_accuracy_stats(result)
+	result = parse_twoway(result)
 	
 	return result
 
 
-def feature_match(x, y, x_match=None, partition_attr=None, metric='correlation', do_negate=True):
+def feature_match(x, y, x_match=None, partition_attr=None, metric='correlation', do_negate=True, plans=None):
 	"""reorder the features of x so they match as closely as possible those
 	of y.
 	
@@ -384,6 +761,11 @@ def feature_match(x, y, x_match=None, partition_attr=None, metric='correlation',
 	do_negate: boolean, optional
 	  for correlation metric, true to allow anti-correlated features to
 	  match, with those features being marked for negation
+	plans : dict, optional
+	  a dict mapping partition values (or None if partition_attr is None) to
+	  previously calculated feature match plans (see
+	  get_feature_match_plan). plans that are missing are calculated and
+	  added to the dict.
 	
 	Returns
 	-------
@@ -392,6 +774,8 @@ def feature_match(x, y, x_match=None, partition_attr=None, metric='correlation',
 	"""
 	if x_match is None:
 		x_match = x
+	if plans is None:
+		plans = {}
 	
 	#error checking
 	if x.shape[1] % y.shape[1] != 0:
@@ -406,78 +790,227 @@ def feature_match(x, y, x_match=None, partition_attr=None, metric='correlation',
 		partition_values = np.unique(x.sa[partition_attr])
 		for val in partition_values:
 			samples = x.sa[partition_attr].value == val
-			other_samples = x.sa[partition_attr].value != val
-			x_matched = feature_match(x[samples,:], y[other_samples,:], x_match=x_match[other_samples,:], metric=metric, do_negate=do_negate)
+			
+			if not val in plans:
+				#y and x_match are partitioned by their own sample attributes
+				other_y = y.sa[partition_attr].value != val
+				if isinstance(x_match, Dataset):
+					other_x_match = x_match.sa[partition_attr].value != val
+				else:
+					other_x_match = other_y
+				
+				plans[val] = get_feature_match_plan(y[other_y,:], x_match[other_x_match,:], metric=metric, do_negate=do_negate)
+			
+			idx, negate = plans[val]
+			x_matched = apply_feature_match_plan(x[samples,:], idx, negate)
 			
 			if isinstance(x, Dataset):
 				x.samples[samples,:] = x_matched
 			else:
 				x[samples,:] = x_matched
 	else: #perform feature matching on the whole dataset
-		#calculate the distance between each pair of features in x and y
-		D = pairwise_distances(np.transpose(y),np.transpose(x_match),metric=metric)
-		
-		#make negative correlations positive, and mark them for negating if they
-		#end up being matches
-		corr_negate = metric=='correlation' and do_negate
-		if corr_negate:
-			negate = D > 1
-			D[negate] = 2 - D[negate]  # 1 - (-(1 - D))
-			
-			#anything negative now is just due to floating point error
-			D[D<0] = 0
+		if not None in plans:
+			plans[None] = get_feature_match_plan(y, x_match, metric=metric, do_negate=do_negate)
 		
-		#fix nans
+		idx, negate = plans[None]
+		x = apply_feature_match_plan(x, idx, negate)
+	
+	return x
+
+
+def feature_correlation(x, y):
+	"""calculate the correlation between each feature of x and each feature of
+	y, using a single matrix product of the standardized data
+	
+	Parameters
+	----------
+	x : array
+	  an nSample x nFeatureX array
+	y : array
+	  an nSample x nFeatureY array
+	
+	Returns
+	-------
+	r : array
+	  an nFeatureX x nFeatureY array of correlation coefficients. features
+	  with zero variance have nan correlations.
+	"""
+	def standardize(z):
+		z = np.array(z, dtype=np.float64)
+		z -= np.mean(z, axis=0)
+		z /= np.sqrt(np.sum(z**2, axis=0))
+		return z
+	
+	return np.dot(standardize(x).T, standardize(y))
+
+
+def solve_assignment(D):
+	"""find the assignment of columns to rows of a square cost matrix that
+	minimizes the total cost
+	
+	Parameters
+	----------
+	D : array
+	  an nRow x nCol cost matrix
+	
+	Returns
+	-------
+	idx : array
+	  the column index assigned to each row
+	"""
+	if linear_sum_assignment is not None:
+		row, col = linear_sum_assignment(D)
+		idx = np.empty(D.shape[0], dtype=int)
+		idx[row] = col
+		return idx
+	else:
+		return linear_assignment(D)[:,1]
+
+
+def get_feature_match_plan(y, x_match, metric='correlation', do_negate=True):
+	"""calculate the feature order that matches the features of x_match as
+	closely as possible to those of y. plans are cached by the content of
+	y and x_match, so repeated matchings of the same data (e.g. the same cv
+	fold across permutations) are only solved once.
+	
+	Parameters
+	----------
+	y : array
+	  a two-dimensional array or Dataset
+	x_match : array
+	  an array or Dataset with the same size as y
+	metric : str, optional
+	  see feature_match
+	do_negate: boolean, optional
+	  see feature_match
+	
+	Returns
+	-------
+	idx : array
+	  the feature of x_match to assign to each feature of y
+	negate : array
+	  a boolean array indicating which of the reordered features should be
+	  negated, or None if no features are negated
+	"""
+	y = np.asarray(y.samples if isinstance(y, Dataset) else y)
+	x_match = np.asarray(x_match.samples if isinstance(x_match, Dataset) else x_match)
+	
+	#check for a cached plan
+	h = hashlib.sha1()
+	h.update(json.dumps([metric, do_negate, y.shape, str(y.dtype), str(x_match.dtype)]))
+	h.update(np.ascontiguousarray(y).data)
+	h.update(np.ascontiguousarray(x_match).data)
+	key = h.hexdigest()
+	
+	if key in _feature_match_cache:
+		return _feature_match_cache[key]
+	
+	#calculate the distance between each pair of features in x and y
+	if metric=='correlation':
+		plan = correlation_match_plan(feature_correlation(y, x_match), do_negate=do_negate)
+	else:
+		D = pairwise_distances(np.transpose(y),np.transpose(x_match),metric=metric)
 		D[np.isnan(D)] = 0
 		
-		#minimize the trace in order to find a matching of features that
-		#minimizes matched feature distances
-		rc_idx = linear_assignment(D)
-		idx = rc_idx[:,1]
-		
-		#apply the reordering to the negate array
-		if corr_negate:
-			negate = negate[:,idx]
-			
-			#keep only the diagonal (i.e. pair matched) values
-			diag = np.eye(y.shape[1], dtype=bool)
-			negate = negate[diag]
+		plan = (solve_assignment(D), None)
+	
+	if len(_feature_match_cache) >= FEATURE_MATCH_CACHE_SIZE:
+		_feature_match_cache.clear()
+	_feature_match_cache[key] = plan
+	
+	return plan
+
+
+def correlation_match_plan(r, do_negate=True):
+	"""calculate a feature match plan from a feature correlation matrix
+	
+	Parameters
+	----------
+	r : array
+	  an nFeatureY x nFeatureX correlation matrix (see feature_correlation)
+	do_negate: boolean, optional
+	  see feature_match
+	
+	Returns
+	-------
+	idx : array
+	  see get_feature_match_plan
+	negate : array
+	  see get_feature_match_plan
+	"""
+	#make negative correlations positive, and mark them for negating if they
+	#end up being matches
+	if do_negate:
+		negate = r < 0
+		D = 1 - np.abs(r)
+	else:
+		D = 1 - r
+	
+	#anything negative now is just due to floating point error
+	D[D<0] = 0
+	
+	#fix nans
+	D[np.isnan(D)] = 0
+	
+	#minimize the trace in order to find a matching of features that
+	#minimizes matched feature distances
+	idx = solve_assignment(D)
+	
+	#keep only the negate values of matched pairs
+	if do_negate:
+		negate = negate[np.arange(len(idx)),idx]
+	else:
+		negate = None
+	
+	return idx, negate
+
+
+def apply_feature_match_plan(x, idx, negate=None):
+	"""reorder (and optionally negate) the features of x according to a plan
+	from get_feature_match_plan
+	
+	Parameters
+	----------
+	x : array
+	  a two-dimensional array or Dataset. its number of features must be an
+	  integer multiple of the length of idx, in which case the new order is
+	  repeated to fill the feature space of x.
+	idx : array
+	  the new feature order
+	negate : array, optional
+	  a boolean array indicating which reordered features to negate
+	
+	Returns
+	-------
+	x : array
+	  a reordered copy of x
+	"""
+	#make sure the new order matches the feature space of x
+	if x.shape[1] != len(idx):
+		mult = x.shape[1]/len(idx)
 		
-		#make sure the new order matches the feature space of x
-		if x.shape[1] != y.shape[1]:
-			mult = x.shape[1]/y.shape[1]
-			
-			idx = np.concatenate([ idx + n*y.shape[1] for n in np.arange(mult) ])
-			
-			if corr_negate:
-				negate = np.tile(negate,mult)
+		idx = np.concatenate([ idx + n*len(idx) for n in np.arange(mult) ])
 		
-		#apply the new feature order to x
+		if negate is not None:
+			negate = np.tile(negate,mult)
+	
+	#apply the new feature order to x
+	if isinstance(x, Dataset):
+		x = x.copy(deep=1)
+		x.samples[:,:] = x.samples[:,idx]
+	else:
+		x = x[:,idx]
+	
+	#negate the marked samples
+	if negate is not None:
 		if isinstance(x, Dataset):
-			x = x.copy(deep=1)
-			x.samples[:,:] = x.samples[:,idx]
+			x.samples[:,negate] = -x.samples[:,negate]
 		else:
-			x = x[:,idx]
-		
-		#negate the marked samples
-		if corr_negate:
-			if isinstance(x, Dataset):
-				x.samples[:,negate] = -x.samples[:,negate]
-			else:
-				x[:,negate] = -x[:,negate]
+			x[:,negate] = -x[:,negate]
 	
 	return x
 
 
-def regr_residual(x, y):
-	"""calculate the variance of the residual obtained by using linear
-	regression to predict 1-D signal x from 2-D set of signals y"""
-	regr = linear_model.LinearRegression()
-	regr.fit(x, y)
-	err = regr.predict(x) - y
-	return np.var(err)
-
-
 def construct_lags(x, lags, idx_sample):
 	"""construct the lagged signals to be used in a directed connectivity
 	calculation.
@@ -485,7 +1018,7 @@ def construct_lags(x, lags, idx_sample):
 	Parameters
 	----------
 	x : array
-	  a 1D signal
+	  a num_sample x K array of K signals
 	lags : int
 	  the number of lags to use in the directed connectivity calculation
 	idx_sample : array
@@ -495,10 +1028,11 @@ def construct_lags(x, lags, idx_sample):
 	Returns
 	-------
 	x_lag : array
-	  a num_sample x lags array of the lagged signals
+	  a num_sample x (lags * K) array of the lagged signals (all K signals at
+	  lag 1, then all K signals at lag 2, etc.)
 	"""
 	x_lag = [construct_lag(x, lag, idx_sample) for lag in range(1,lags+1)]
-	return hstack(x_lag)
+	return np.hstack(x_lag)
 
 
 def construct_lag(x, lag, idx_sample):
@@ -522,6 +1056,140 @@ def construct_lag(x, lag, idx_sample):
 	return x[idx_sample - lag]
 
 
+def batch_solve(a, b):
+	"""solve a stack of linear systems a[k] x[k] = b[k], falling back to least
+	squares for the whole stack if any of the systems is singular"""
+	try:
+		return np.linalg.solve(a, b[...,np.newaxis])[...,0]
+	except np.linalg.LinAlgError:
+		return np.array([np.linalg.lstsq(a_k, b_k, rcond=-1)[0] for a_k, b_k in zip(a, b)])
+
+
+def granger_causality_patterns(src, dst, lags=1, idx_sample=None, criterion=None):
+	"""calculate the granger causality from every source signal to every
+	destination signal at once. rather than fitting two regressions for each
+	pair of signals, this computes the cross-products of the (centered)
+	lagged signals once and solves the normal equations of the full models of
+	all source signals in a single batch for each destination signal. the
+	reduced model (the destination's own past) is shared by every source.
+	
+	if several lag orders are requested, the cross-products are computed once
+	for the largest order, and the models for each smaller order use the
+	leading blocks of those cross-products.
+	
+	Parameters
+	----------
+	src : array
+	  a num_sample x M array of source signals
+	dst : array
+	  a num_sample x N array of destination signals
+	lags : int | list, optional
+	  the number of lags to use in the granger causality calculation, or a
+	  list of lag orders to calculate the granger causality for
+	idx_sample : array, optional
+	  an array specifying the indices of interest in the arrays (i.e. the
+	  indices to use for the unlagged signals). defaults to the entire signal
+	  (starting from idx==max(lags)).
+	criterion : str, optional
+	  'aic' or 'bic' to choose the lag order of each source/destination pair
+	  from the list of lag orders, using the Akaike or Bayesian information
+	  criterion of the full model
+	
+	Returns
+	-------
+	gc : array
+	  an M x N array of the granger causality from each source signal to each
+	  destination signal. if lags is a list and criterion is unspecified,
+	  then an L x M x N array with one M x N array for each lag order.
+	lag : array
+	  (only if criterion is specified) an M x N array of the lag order chosen
+	  for each pair
+	"""
+	src = np.reshape(np.asarray(src, dtype=np.float64), (len(src), -1))
+	dst = np.reshape(np.asarray(dst, dtype=np.float64), (len(dst), -1))
+	
+	orders = force_list(lags)
+	lag_max = max(orders)
+	
+	if idx_sample is None:
+		idx_sample = arange(lag_max,len(src))
+	
+	num_sample = len(idx_sample)
+	num_src = src.shape[1]
+	num_dst = dst.shape[1]
+	
+	#construct the lagged signals as lags x num_sample x num_signal arrays.
+	#centering everything means the regressions don't need an intercept.
+	src_past = construct_lags(src, lag_max, idx_sample).reshape((num_sample, lag_max, num_src)).transpose((1,0,2))
+	dst_past = construct_lags(dst, lag_max, idx_sample).reshape((num_sample, lag_max, num_dst)).transpose((1,0,2))
+	dst_next = construct_lag(dst, 0, idx_sample)
+	
+	src_past = src_past - np.mean(src_past, axis=1)[:,np.newaxis,:]
+	dst_past = dst_past - np.mean(dst_past, axis=1)[:,np.newaxis,:]
+	dst_next = dst_next - np.mean(dst_next, axis=0)
+	
+	#cross-products of each source's past with itself don't depend on the
+	#destination
+	src_src = np.einsum('lni,mni->ilm', src_past, src_past)
+	
+	gc = np.zeros((len(orders), num_src, num_dst))
+	if criterion is not None:
+		info = np.empty((len(orders), num_src, num_dst))
+	
+	for idx_dst in range(num_dst):
+		x_past = dst_past[:,:,idx_dst]
+		x_next = dst_next[:,idx_dst]
+		
+		next_next = np.dot(x_next, x_next)
+		past_next = np.dot(x_past, x_next)
+		past_past = np.dot(x_past, x_past.T)
+		past_src = np.dot(x_past, src_past).transpose((2,0,1))
+		src_next = np.dot(x_next, src_past).T
+		
+		for idx_order, lag in enumerate(orders):
+			#reduced model: predict dst from its own past
+			coef_reduced = np.linalg.lstsq(past_past[:lag,:lag], past_next[:lag], rcond=-1)[0]
+			res_reduced = next_next - np.dot(past_next[:lag], coef_reduced)
+			
+			#full models: predict dst from its own past and each source's past
+			gram = np.empty((num_src, 2*lag, 2*lag))
+			gram[:,:lag,:lag] = past_past[:lag,:lag]
+			gram[:,:lag,lag:] = past_src[:,:lag,:lag]
+			gram[:,lag:,:lag] = past_src[:,:lag,:lag].transpose((0,2,1))
+			gram[:,lag:,lag:] = src_src[:,:lag,:lag]
+			
+			rhs = np.hstack((np.tile(past_next[:lag], (num_src,1)), src_next[:,:lag]))
+			
+			res_full = next_next - np.sum(rhs * batch_solve(gram, rhs), axis=1)
+			
+			#granger causality is the log of the ratio of the residuals
+			valid = (res_reduced > 0) & (res_full > 0)
+			gc[idx_order,:,idx_dst] = np.where(valid, np.log(res_reduced / res_full), 0)
+			
+			#information criterion of the full model (which also has an
+			#intercept)
+			if criterion is not None:
+				num_param = 2*lag + 1
+				if criterion == 'aic':
+					penalty = 2*num_param
+				elif criterion == 'bic':
+					penalty = num_param*np.log(num_sample)
+				else:
+					raise ValueError("Unrecognized information criterion '%s'." % (criterion))
+				
+				info[idx_order,:,idx_dst] = np.where(res_full > 0, num_sample*np.log(res_full/num_sample) + penalty, np.inf)
+	
+	if criterion is not None:
+		idx_order = np.argmin(info, axis=0)
+		idx_src, idx_dst = np.indices((num_src, num_dst))
+		
+		return gc[idx_order, idx_src, idx_dst], np.array(orders)[idx_order]
+	elif isinstance(lags, list):
+		return gc
+	else:
+		return gc[0]
+
+
 def granger_causality(src, dst, lags=1, idx_sample=None):
 	"""calculate the granger causality between two signals.
 	
@@ -543,25 +1211,12 @@ def granger_causality(src, dst, lags=1, idx_sample=None):
 	gc : float
 	  the granger causality from src to dst
 	"""
-	if idx_sample is None:
-		idx_sample = arange(lags,len(src))
-	
-	#construct the lagged signals
-	src_past = construct_lags(src, lags, idx_sample)
-	dst_past = construct_lags(dst, lags, idx_sample)
-	dst_next = construct_lag(dst, 0, idx_sample)
-	
-	#perform linear regression with reduced (just dst) and full (dst and src)
-	#models
-	res_reduced = regr_residual(dst_past, dst_next)
-	res_full = regr_residual(hstack((dst_past, src_past)), dst_next)
-	
-	#granger causality is the log of the ratio of the residuals
-	return np.log(res_reduced / res_full) if res_reduced>0 and res_full>0 else 0
+	return granger_causality_patterns(src, dst, lags=lags, idx_sample=idx_sample)[0,0]
 
 
 def compute_directed_connectivity_patterns(ds1, ds2, method='granger', lags=1,
-								targets=None, chunks=None
+								lag_select=None, targets=None, chunks=None,
+								memmap=False, block_size=2**20
 								):
 	"""compute patterns of directed connectivity (DC) from one dataset to
 	another. a DC pattern is a graph of the directed connectivity from every
@@ -584,14 +1239,28 @@ def compute_directed_connectivity_patterns(ds1, ds2, method='granger', lags=1,
 	method : str, optional
 	  the method to use for computing directed connectivity between two
 	  signals. currenty only 'granger' (Granger-causality) is implemented.
-	lags : int, optional
-	  the number of lags to use in the directed connectivity calculation
+	lags : int | list, optional
+	  the number of lags to use in the directed connectivity calculation, or
+	  a list of lag orders. for a list, the DC patterns for every lag order
+	  are computed in one pass, and the output dataset contains the patterns
+	  for each lag order side by side, with the feature attribute 'dc_lag'
+	  identifying the lag order of each feature. every lag order uses the
+	  same samples (those that are valid for the largest lag order).
+	lag_select : str, optional
+	  if lags is a list, 'aic' or 'bic' to instead choose the lag order of each
+	  feature pair using the Akaike or Bayesian information criterion. the
+	  output dataset then contains a single DC pattern for each sample.
 	targets : list, optional
 	  a subset of targets for which to calculate DC patterns (defaults to all
 	  targets)
 	chunks : list, optional
 	  a subset of chunks for which to calculate DC patterns (defaults to all
 	  chunks)
+	memmap : bool, optional
+	  true to stream the DC patterns into a float32 array backed by a
+	  temporary file instead of holding them in memory
+	block_size : int, optional
+	  the approximate number of feature pairs to compute at once
 	
 	Returns
 	-------
@@ -599,6 +1268,15 @@ def compute_directed_connectivity_patterns(ds1, ds2, method='granger', lags=1,
 	  the new Dataset representing the set of DC patterns from ds1 to ds2
 	  (one DC pattern for each unique combination of chunk and target)
 	"""
+	orders = force_list(lags)
+	lag_max = max(orders)
+	
+	#the number of lag orders in the output
+	if isinstance(lags, list) and lag_select is None:
+		out_num_lags = len(orders)
+	else:
+		out_num_lags = 1
+	
 	#first do some error checking
 	assert len(ds1)==len(ds2), 'datasets must have the same number of samples'
 	assert np.all(ds1.sa.targets==ds2.sa.targets), 'datasets must have the same targets'
@@ -608,151 +1286,136 @@ def compute_directed_connectivity_patterns(ds1, ds2, method='granger', lags=1,
 	if targets is None:
 		targets = ds1.uniquetargets
 	if chunks is None:
-		chunks = np.unique(ds1.sa.chunks[ array([trg in targets for trg in ds1.sa.targets ]) ])
-	
-	#initialize the output dataset
-	num_chunks = len(chunks)
-	num_targets = len(targets)
-	out_num_samples = num_chunks * num_targets
-	out_num_features = ds1.nfeatures * ds2.nfeatures
-	ds = Dataset(np.zeros((out_num_samples,out_num_features)))
-	ds.sa['chunks'] = np.reshape(np.tile(np.reshape(chunks,[num_chunks,1]),num_targets),[out_num_samples,])
-	ds.sa['targets'] = np.tile(targets,num_chunks)
-	keep_samples = np.ones(out_num_samples, dtype=bool)
+		chunks = np.unique(ds1.sa.chunks[np.isin(ds1.sa.targets, targets)])
 	
 	#find the samples belonging to each chunk and target value
 	chunk_samples = [ds1.sa.chunks==chunk for chunk in chunks]
 	target_samples = [ds1.sa.targets==target for target in targets]
 	
-	#calculate the DC pattern for each chunk and target
-	for idx_chunk in range(0,num_chunks):
-		for idx_target in range(0,num_targets):
+	#get the samples to use for each chunk and target's DC pattern
+	out_chunks = []
+	out_targets = []
+	out_idx_samples = []
+	for chunk, loc_chunk in zip(chunks, chunk_samples):
+		for target, loc_target in zip(targets, target_samples):
 			#samples for the current chunk and target
-			loc_sample = chunk_samples[idx_chunk] & target_samples[idx_target]
+			loc_sample = loc_chunk & loc_target
 			#make sure we don't get anything that will go out of bounds
-			loc_sample[-lags:] = False
+			loc_sample[-lag_max:] = False
 			#get the sample indices
 			idx_sample = np.where( loc_sample )[0]
 			
-			out_idx_sample = num_targets*idx_chunk + idx_target
-			
 			if len(idx_sample)==0:
-				chunk = ds.sa.chunks[out_idx_sample]
-				target = ds.sa.targets[out_idx_sample]
-				keep_samples[out_idx_sample] = False
 				warnings.warn('no samples for chunk=%s and target=%s' % (str(chunk), target))
 				continue
 			
-			for idx_f1 in range(ds1.nfeatures):
-				ds1_feature = ds1.samples[:,[idx_f1]]
-				for idx_f2 in range(ds2.nfeatures):
-					ds2_feature = ds2.samples[:,[idx_f2]]
-					
-					gc = granger_causality(ds1_feature, ds2_feature,
-									lags=lags, idx_sample=idx_sample+lags
-									)
-					
-					out_idx_feature = ds2.nfeatures*idx_f1 + idx_f2
-					
-					ds.samples[out_idx_sample, out_idx_feature] = gc
+			out_chunks.append(chunk)
+			out_targets.append(target)
+			out_idx_samples.append(idx_sample)
 	
-	return ds[keep_samples,:]
-
-
-class Locker(object):
-	"""object to prevent other processes from doing something until we are
-	finished"""
-	_interval = 0.5
-	_timeout = 3
+	#initialize the output dataset
+	out_num_samples = len(out_idx_samples)
+	out_shape = (out_num_samples, out_num_lags * ds1.nfeatures * ds2.nfeatures)
+	if memmap:
+		samples = memmap_empty(out_shape, dtype=np.float32)
+	else:
+		samples = np.zeros(out_shape)
 	
-	_pair_id = None
+	#the number of ds2 features to compute at once
+	block_features = max(1, block_size / (out_num_lags * ds1.nfeatures))
 	
-	path = {}
+	#calculate the DC pattern for each chunk and target
+	for out_idx_sample, idx_sample in enumerate(out_idx_samples):
+		#the DC pattern from every ds1 feature to every ds2 feature, computed
+		#in blocks of ds2 features
+		pattern = samples[out_idx_sample].reshape((out_num_lags, ds1.nfeatures, ds2.nfeatures))
+		
+		for idx_start in range(0, ds2.nfeatures, block_features):
+			idx_end = min(idx_start + block_features, ds2.nfeatures)
+			
+			gc = granger_causality_patterns(
+				ds1.samples, ds2.samples[:,idx_start:idx_end],
+				lags=lags, idx_sample=idx_sample+lag_max,
+				criterion=lag_select
+				)
+			
+			if lag_select is not None:
+				gc = gc[0]
+			
+			pattern[:,:,idx_start:idx_end] = np.reshape(gc, (out_num_lags, ds1.nfeatures, idx_end - idx_start))
+	
+	ds = Dataset(samples)
+	ds.sa['chunks'] = out_chunks
+	ds.sa['targets'] = out_targets
+	
+	if out_num_lags > 1:
+		ds.fa['dc_lag'] = np.repeat(orders, ds1.nfeatures * ds2.nfeatures)
+	
+	return ds
+
+
+class Semaphore(object):
+	"""N-way cross-process semaphore based on kernel file locks. each of the
+	semaphore's slots is a lock file that is held with flock(), so a slot is
+	released automatically if its holder dies. a blocked waiter polls every
+	slot, so it takes whichever slot is released first."""
+	_interval = 0.01
 	
 	name = None
-	paired = False
-	duration = None
+	slots = 1
 	
-	@property
-	def age(self):
-		"""age of the lock file, in seconds"""
-		try:
-			return time.time() - os.path.getmtime(self.path['lock'])
-		except Exception:
-			return np.inf
+	wait_time = None
 	
-	def wait(self):
-		"""wait until the lock file is gone or times out"""
-		while self._locked() and self.age < self._timeout:
-			self._sleep()
-		
-	def start(self):
-		"""start the lock"""
+	_file = None
+	
+	def acquire(self):
+		"""acquire a slot, blocking until one is available. returns the time
+		spent waiting, in seconds."""
 		start_time = time.time()
 		
-		while self._continue() and time.time() - start_time < self.duration:
-			self._touch('lock')
-			self._sleep()
+		#take any free slot, waiting until one is released if they are all busy
+		while not any(self._lock(slot, block=False) for slot in range(self.slots)):
+			time.sleep(self._interval)
 		
-		self._clear()
+		self.wait_time = time.time() - start_time
 		
-	def stop(self):
-		"""stop the lock"""
-		self._touch('stop')
+		return self.wait_time
 	
-	def __init__(self, name, paired=False, duration=np.inf, pair_id=None):
-		self.name = name
-		self.paired = paired
-		self.duration = duration
-		
-		if self.paired:
-			self._pair_id = pair_id if pair_id is not None else int(time.time()*1000000)
-		
-		self.path['lock'] = self._get_path('lock')
-		self.path['stop'] = self._get_path('stop', paired=True)
+	def release(self):
+		"""release the slot we hold"""
+		if self._file is not None:
+			fcntl.flock(self._file, fcntl.LOCK_UN)
+			self._file.close()
+			self._file = None
 	
-	def _get_path(self, name, paired=False):
-		"""get the path to a signal file"""
-		if paired and self.paired:
-			pre = '%s%d' % (self.name, self._pair_id)
-		else:
-			pre = self.name			
-		
-		return os.path.join('/tmp','%s.%s' % (pre, name))
+	def __init__(self, name, slots=1):
+		self.name = name
+		self.slots = max(1, int(slots))
 	
-	def _exists(self, name):
-		"""does a file exist?"""
-		return os.path.exists(self.path[name])
+	def __enter__(self):
+		self.acquire()
+		return self
 	
-	def _touch(self, name):
-		"""update a file's modification time"""
-		with file(self.path[name],'a'):
-			os.utime(self.path[name],None)
+	def __exit__(self, *args):
+		self.release()
 	
-	def _remove(self, name):
-		"""remove a file"""
-		if self._exists(name):
-			try:
-				os.remove(self.path[name])
-			except Exception:
-				pass
-
-	def _locked(self):
-		"""are we locked"""
-		return self._exists('lock')
+	def _get_path(self, slot):
+		"""get the path to a slot's lock file"""
+		return os.path.join('/tmp','%s.%d.lock' % (self.name, slot))
 	
-	def _continue(self):
-		"""should we continue locking?"""
-		return not self._exists('stop')
-	
-	def _clear(self):
-		"""clear all the files"""
-		for name in self.path:
-			self._remove(name)
-	
-	def _sleep(self):
-		"""wait a bit"""
-		time.sleep(self._interval)
+	def _lock(self, slot, block=True):
+		"""try to lock a slot"""
+		f = open(self._get_path(slot), 'a')
+		
+		try:
+			fcntl.flock(f, fcntl.LOCK_EX if block else fcntl.LOCK_EX | fcntl.LOCK_NB)
+		except IOError:
+			f.close()
+			return False
+		
+		self._file = f
+		
+		return True
 
 
 class Parameters(dict):
@@ -816,6 +1479,26 @@ class Parameters(dict):
 			set_target = set_target.difference(set_blank)
 		self['target_subset'] = list(set_target)
 		
+		#lag order selection for directed connectivity classifications
+		if self['dcclassify_lag_select'] == 'none':
+			self['dcclassify_lag_select'] = None
+		elif self['dcclassify_lag_select'] not in ['aic', 'bic']:
+			raise Exception("Unrecognized dcclassify_lag_select parameter.")
+		elif not isinstance(self['dcclassify_lags'], list):
+			raise Exception('dcclassify_lags must be a list of lag orders to choose from.')
+		
+		#sequential stopping of permutation tests
+		if self['permutation_stop'] == 'none':
+			self['permutation_stop'] = None
+		elif self['permutation_stop'] not in ['besag', 'alpha']:
+			raise Exception("Unrecognized permutation_stop parameter.")
+		
+		#format of the mask result files
+		if self['result_format'] not in ['mat', 'hdf5']:
+			raise Exception("Unrecognized result_format parameter.")
+		elif self['result_format'] == 'hdf5' and h5py is None:
+			raise Exception('h5py is required to save results in the hdf5 format.')
+		
 		#parse the partitioner
 		if isinstance(self['partitioner'], int):
 			self['partitioner'] = NFoldPartitioner(cvtype=self['partitioner'])
@@ -828,6 +1511,23 @@ class Parameters(dict):
 		#construct the classifiers. make sure we have () at the end.
 		self['classifier'] = [eval(re.sub(r'([^\)])$',r'\1()',clf)) for clf in self['classifier']]
 		
+		#the preprocessed dataset cache
+		if self['cache_dir']:
+			self['cache'] = DatasetCache(self['cache_dir'], size=self['cache_size'])
+		else:
+			self['cache'] = None
+		
+		#the classification checkpoint store. runs that force each mask to be
+		#reclassified never read the checkpoints back, so they don't need one.
+		if self['checkpoint'] and not self['force_each']:
+			path_dir, path_pre, path_ext = split_path(self['path_result'])
+			self['checkpoint'] = CheckpointStore(os.path.join(path_dir, '%s.checkpoint.sqlite' % (path_pre)))
+		else:
+			self['checkpoint'] = None
+		
+		self['checkpoint_fingerprint'] = None
+		self['dc_lag'] = None
+		
 		#do some error checking
 		if len(self['classifier']) > 1 and self['sensitivities']:
 			raise Exception('Sensitivities cannot be saved if more than one classifier is specified.')
@@ -901,10 +1601,24 @@ class Mask(FileObject):
 		
 		return mask
 
+class HDF5Array(FileObject):
+	"""an array in an HDF5 mask result that is only read once it is needed.
+	these get sent back from the mask worker processes, so they don't keep a
+	reference to the parameters."""
+	def __init__(self, path, name):
+		FileObject.__init__(self, None, path, name)
+	
+	def _loader(self, path, name):
+		"""read the array"""
+		with h5py.File(path, 'r') as f:
+			return f[name][...]
+
 class Masks(dict):
 	"""container for the masks that will be used in the classification"""
 	param = None
 	
+	union = None
+	
 	def __init__(self, param, *args, **kwargs):
 		dict.__init__(self, *args, **kwargs)
 		
@@ -915,33 +1629,54 @@ class Masks(dict):
 				mask_name = self.param['mask_name'][idx]
 				self[mask_name] = Mask(param, idx)
 			
+			if param['mask_union']:
+				self.union = self._get_union()
+			
 			if param['mask_balancer']=='bootstrap':
 				param['mask_size_min'] = min([self[mask]().a.size for mask in self])
+	
+	def _get_union(self):
+		"""restrict every mask to the union of all the masks' voxels, so the
+		data only need to be loaded for voxels that are in at least one mask.
+		returns a NIfTI image of the union mask."""
+		status('restricting %d masks to their union' % (len(self)), indent=1, debug='all')
+		
+		masks = [self[mask]() for mask in self]
+		
+		union = np.any(np.vstack([mask.samples[0] for mask in masks]), axis=0)
+		union_image = map2nifti(masks[0], data=union[np.newaxis,:].astype(np.int16))
+		
+		#each mask's indices now refer to the compact union feature space
+		for mask in self:
+			mask_union = self[mask]()[:,union]
+			mask_union.a['idx'] = np.nonzero(mask_union)[1]
+			
+			self[mask].obj = mask_union
+		
+		status('union mask has %d voxels' % (np.sum(union)), indent=2, debug='all')
+		
+		return union_image
 
 class Data(FileObject):
 	"""classification data"""
-	def _loader(self):
+	def _loader(self, mask=None):
 		status('loading data')
 		
 		#data parameters
 		samples = force_list(self.param['path_data'])
 		attr = SampleAttributes(self.param['path_attribute'])
 		
-		#lock object to make sure only one process loads data at a time
-		lock = Locker(name='mvpaclassify_load_data', paired=True, duration=300)
+		#semaphore to limit the number of processes that load data at once
+		lock = Semaphore('mvpaclassify_load_data', slots=self.param['load_slots'])
 		
-		#wait until the lock is free
-		lock.wait()
-		
-		#fork a child process that will maintain the lock until the data are
-		#loaded
-		pid = os.fork()
-		if pid:  # parent
+		with lock:
+			status('waited %.3f s for a loading slot' % (lock.wait_time), indent=1)
+			
 			#load the data
 			ds = []
 			for idx, s in enumerate(samples):
 				#load the dataset
-				ds_cur = fmri_dataset(samples=s, chunks=attr.chunks, targets=attr.targets)
+				ds_cur = fmri_dataset(samples=s, chunks=attr.chunks, targets=attr.targets, mask=mask)
 				#add a sample attribute to keep track of the datasets
 				ds_cur.sa['dataset'] = [idx+1]
 				
@@ -953,55 +1688,281 @@ class Data(FileObject):
 				ds.append(ds_cur)
 			#stack the datasets
 			ds = vstack(tuple(ds))
+		
+		#keep just the union of the mask voxels in a memory-mapped array that
+		#forked processes can share
+		if mask is not None:
+			status('memory-mapping %s union mask samples' % (str(ds.shape)), indent=1, debug='all')
+			ds.samples = memmap_array(ds.samples)
+		
+		return ds
+
+
+class DatasetCache(object):
+	"""content-addressed on-disk cache of preprocessed datasets. each entry is
+	a directory named by the hash of everything that went into constructing
+	the dataset. the samples are stored as a .npy file so they can be
+	memory-mapped, and the sample, feature, and dataset attributes are stored
+	in a pickle file alongside them. once the cache grows beyond its size
+	limit, the least recently used entries are evicted."""
+	path = None
+	size = np.inf
+	
+	def get_key(self, signature):
+		"""get the cache key for a json-serializable signature"""
+		return hashlib.sha1(json.dumps(signature, sort_keys=True)).hexdigest()
+	
+	def load(self, key):
+		"""load a dataset from the cache. returns None if the dataset isn't
+		cached."""
+		path_entry = self._get_path(key)
+		
+		if not os.path.isdir(path_entry):
+			return None
+		
+		try:
+			samples = np.load(os.path.join(path_entry, 'samples.npy'), mmap_mode='c')
 			
-			#stop the lock
-			lock.stop()
-		else:  # child
-			#lock the process
-			lock.start()
+			with open(os.path.join(path_entry, 'attributes.pickle'), 'rb') as f:
+				attr = pickle.load(f)
+		except Exception:  # e.g. evicted by another process while loading
+			return None
+		
+		#mark the entry as recently used
+		os.utime(path_entry, None)
+		
+		return Dataset(samples, sa=attr['sa'], fa=attr['fa'], a=attr['a'])
+	
+	def save(self, key, ds):
+		"""save a dataset to the cache"""
+		path_entry = self._get_path(key)
+		
+		if os.path.isdir(path_entry):
+			return
+		
+		#write to a temporary directory first so other processes never see a
+		#partial entry
+		path_tmp = tempfile.mkdtemp(prefix='.tmp-', dir=self.path)
+		
+		np.save(os.path.join(path_tmp, 'samples.npy'), ds.samples)
+		
+		with open(os.path.join(path_tmp, 'attributes.pickle'), 'wb') as f:
+			pickle.dump({'sa': ds.sa, 'fa': ds.fa, 'a': ds.a}, f, protocol=pickle.HIGHEST_PROTOCOL)
+		
+		try:
+			os.rename(path_tmp, path_entry)
+		except OSError:  # another process beat us to it
+			shutil.rmtree(path_tmp, ignore_errors=True)
+		
+		self._evict()
+	
+	def __init__(self, path, size=np.inf):
+		"""
+		Parameters
+		----------
+		path : str
+		  the cache directory
+		size : float, optional
+		  the maximum size of the cache, in MB
+		"""
+		self.path = path
+		self.size = size * 2**20
+		
+		if not os.path.isdir(self.path):
+			os.makedirs(self.path)
+	
+	def _get_path(self, key):
+		"""get the path to a cache entry"""
+		return os.path.join(self.path, key)
+	
+	def _evict(self):
+		"""evict least recently used entries until we are within the size
+		limit"""
+		entries = []
+		for name in os.listdir(self.path):
+			path_entry = self._get_path(name)
+			
+			if name.startswith('.') or not os.path.isdir(path_entry):
+				continue
+			
+			try:
+				mtime = os.path.getmtime(path_entry)
+				size = sum([os.path.getsize(os.path.join(path_entry, f)) for f in os.listdir(path_entry)])
+			except OSError:
+				continue
 			
-			os._exit(0)
+			entries.append((mtime, size, path_entry))
 		
-		return ds
+		total_size = sum([entry[1] for entry in entries])
+		
+		for mtime, size, path_entry in sorted(entries):
+			if total_size <= self.size:
+				break
+			
+			status('evicting %s from the dataset cache' % (path_entry), debug='all')
+			shutil.rmtree(path_entry, ignore_errors=True)
+			
+			total_size -= size
+
+
+class CheckpointStore(object):
+	"""SQLite journal of finished classify_one results, so that an
+	interrupted run can pick up where it left off. each entry is keyed by the
+	mask, mask bootstrap, directed connectivity lag order, classification
+	name, and whether it is a mean control classification, and is tagged with
+	a fingerprint of everything that determines its outcome. entries whose
+	fingerprint doesn't match the current one are ignored."""
+	path = None
+	
+	def get_key(self, param, mean_control=False):
+		"""get the key of the current classification"""
+		mask_name, bootstrap, lag, name, mean_control = get_classification_key(param, mean_control)
+		
+		return (
+			mask_name or '',
+			-1 if bootstrap is None else bootstrap,
+			-1 if lag is None else lag,
+			name,
+			int(mean_control),
+			)
+	
+	def load(self, param, mean_control=False):
+		"""load the result of the current classification. returns None if
+		the classification hasn't been checkpointed."""
+		con = self._connect()
+		try:
+			row = con.execute(
+				'SELECT result FROM result WHERE mask=? AND bootstrap=? AND lag=? AND name=? AND mean_control=? AND fingerprint=?',
+				self.get_key(param, mean_control) + (param['checkpoint_fingerprint'],)
+				).fetchone()
+		finally:
+			con.close()
+		
+		if row is None:
+			return None
+		
+		return pickle.loads(str(row[0]))
+	
+	def save(self, param, result, mean_control=False):
+		"""record the result of the current classification"""
+		blob = sqlite3.Binary(pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL))
+		
+		con = self._connect()
+		try:
+			with con:
+				con.execute(
+					'INSERT OR REPLACE INTO result VALUES (?,?,?,?,?,?,?)',
+					self.get_key(param, mean_control) + (param['checkpoint_fingerprint'], blob)
+					)
+		finally:
+			con.close()
+	
+	def clear(self, mask_name=None, bootstrap=None):
+		"""remove the entries for a mask (and bootstrap) whose results have
+		been saved"""
+		con = self._connect()
+		try:
+			with con:
+				con.execute(
+					'DELETE FROM result WHERE mask=? AND bootstrap=?',
+					(mask_name or '', -1 if bootstrap is None else bootstrap)
+					)
+		finally:
+			con.close()
+	
+	def remove(self):
+		"""delete the database file once the whole run has finished"""
+		if os.path.exists(self.path):
+			os.remove(self.path)
+	
+	def __init__(self, path):
+		"""
+		Parameters
+		----------
+		path : str
+		  the path to the SQLite database file
+		"""
+		self.path = path
+		
+		con = self._connect()
+		try:
+			with con:
+				con.execute('''CREATE TABLE IF NOT EXISTS result (
+					mask TEXT, bootstrap INTEGER, lag INTEGER, name TEXT,
+					mean_control INTEGER, fingerprint TEXT, result BLOB,
+					PRIMARY KEY (mask, bootstrap, lag, name, mean_control)
+					)''')
+		finally:
+			con.close()
+	
+	def _connect(self):
+		"""open a connection to the database. connections aren't kept open
+		so the store can be used from forked worker processes."""
+		return sqlite3.connect(self.path, timeout=600)
 
 
 class Result(dict):
 	param = None
 	
 	output_path = None
+	output_format = None
 	
 	def exists(self):
 		return os.path.exists(self.output_path)
 	
 	def save(self, indent=0):
-		"""save the results to a MATLAB .mat file"""
+		"""save the results to a MATLAB .mat file or an HDF5 file"""
 		status('saving results to %s' % (self.output_path), indent=indent, debug='all')
-		scipy.io.savemat(
-			self.output_path,
-			{'result': self},
-			oned_as='column',
-			do_compression=True
-		)
+		
+		if self.output_format == 'hdf5':
+			with h5py.File(self.output_path, 'w') as f:
+				save_hdf5(f, 'result', self)
+		else:
+			scipy.io.savemat(
+				self.output_path,
+				{'result': self},
+				oned_as='column',
+				do_compression=True
+			)
 	
 	def load(self):
-		"""load existing results"""
+		"""load existing results. large arrays in HDF5 results aren't read
+		until they are needed."""
 		status('loading results from %s' % (self.output_path), debug='all')
 		
-		result = rec2dict(scipy.io.loadmat(self.output_path)['result'])
+		if self.output_format == 'hdf5':
+			with h5py.File(self.output_path, 'r') as f:
+				result = load_hdf5(f['result'], lazy=True)
+		else:
+			result = rec2dict(scipy.io.loadmat(self.output_path)['result'])
 		
 		for key in result:
 			self[key] = result[key]
 	
-	def __init__(self, param, mask=None, *args, **kwargs):
+	def __init__(self, param, mask=None, bootstrap=None, *args, **kwargs):
 		dict.__init__(self, *args, **kwargs)
 		
 		self.param = param
 		
 		self.output_path = self.param['path_result']
 		
+		#the final result is always a .mat file. the mask results can be saved
+		#as HDF5 instead.
+		if mask or bootstrap is not None:
+			self.output_format = self.param['result_format']
+		else:
+			self.output_format = 'mat'
+		
+		if self.output_format == 'hdf5':
+			self.output_path = '%s.h5' % (os.path.splitext(self.output_path)[0])
+		
 		if mask:
 			mask_suffix = '-%s' % (mask.name)
 			self.output_path = add_file_suffix(self.output_path, mask_suffix)
+		
+		if bootstrap is not None:
+			bootstrap_suffix = '-bootstrap%d' % (bootstrap)
+			self.output_path = add_file_suffix(self.output_path, bootstrap_suffix)
 
 
 class NCTrainingStats(dict):
@@ -1034,11 +1995,18 @@ class MatchedDatasetCrossClassifier(ProxyClassifier):
 	__partition_attr = None #the sa used to partition for cross-validation
 	__partition_attr_append = None #values of the partition sa to add for feature matching
 	__match_partition_attr = None #the sa to use to partition for feature matching
+	__match_incremental = False #true to match from incrementally updated sums
+	
+	__match_source = None #hash of the match data that the cached plans belong to
+	__match_plans = None #cached feature match plans, keyed by partition values
+	__match_cells = None #sufficient statistics for each chunk/target cell
+	__match_sums = None #running sums of cell statistics for each target
 	
 	def __init__(self, clf, dataset_attr='dataset', match_features=False,
 				match_data=None, partition_attr='chunks',
 				partition_attr_append=None,
-				match_partition_attr='targets', *args, **kwargs):
+				match_partition_attr='targets', match_incremental=False,
+				*args, **kwargs):
 		"""Initialize the instance of MatchedDatasetCrossClassifier
 		
 		Parameters
@@ -1089,6 +2057,16 @@ class MatchedDatasetCrossClassifier(ProxyClassifier):
 		  same value of this attribute, but using the data from all samples
 		  that don't share that value. this is done to avoid artificially
 		  inflating the similarity between datasets.
+		match_incremental : bool, optional
+		  if match_data is specified, calculate the feature matching
+		  correlations from sums of per-partition_attr/match_partition_attr
+		  statistics that are updated as partition values enter and leave
+		  the training data, rather than from scratch for each fold. this
+		  stores an nFeature x nFeature matrix for each cell.
+		
+		if match_data is specified, feature match plans are cached for each
+		set of partition_attr values, so folds and permutations that use the
+		same match data only calculate them once.
 		"""
 		#untrain the existing classifier (i get deepcopy errors if the
 		#classifier has been used already)
@@ -1110,6 +2088,16 @@ class MatchedDatasetCrossClassifier(ProxyClassifier):
 		self.__partition_attr = partition_attr
 		self.__partition_attr_append = partition_attr_append
 		self.__match_partition_attr = match_partition_attr
+		self.__match_incremental = match_incremental
+		
+		self._reset_match_cache()
+	
+	def _reset_match_cache(self, source=None):
+		"""clear the cached feature match plans and statistics"""
+		self.__match_source = source
+		self.__match_plans = {}
+		self.__match_cells = {}
+		self.__match_sums = {}
 	
 	def _get_dataset_attr(self, dataset):
 		"""get the sample attribute array that identifies the dataset to
@@ -1133,29 +2121,144 @@ class MatchedDatasetCrossClassifier(ProxyClassifier):
 		
 		return [ds1, ds2]
 	
+	def _get_match_source(self, dataset):
+		"""get the manually-defined feature match dataset"""
+		if isinstance(self.__match_data, basestring):
+			#a dataset attribute was specified
+			return dataset.a[self.__match_data].value
+		else:
+			#a dataset was specified
+			return self.__match_data
+	
+	def _get_match_chunks(self, dataset):
+		"""get the cv partition attribute values to include in feature
+		matching"""
+		chunks = np.unique(dataset.sa[self.__partition_attr].value)
+		if not self.__partition_attr_append is None:
+			chunks = np.unique(np.append(chunks,self.__partition_attr_append))
+		
+		return chunks
+	
 	def _get_match_data(self, dataset):
 		"""get the data to use for feature matching"""
 		if not self.__match_data is None:
-			#get the manually-defined dataset
-			if isinstance(self.__match_data, basestring):
-				#a dataset attribute was specified
-				ds = dataset.a[self.__match_data].value
-			else:
-				#a dataset was specified
-				ds = self.__match_data
-			
-			#get the cv partition attribute values to include in feature matching
-			chunks = np.unique(dataset.sa[self.__partition_attr].value)
-			if not self.__partition_attr_append is None:
-				chunks = np.unique(np.append(chunks,self.__partition_attr_append))
+			ds = self._get_match_source(dataset)
+			chunks = self._get_match_chunks(dataset)
 			
 			#include only samples with these attribute values
-			ds = ds[array([ x in chunks for x in ds.sa[self.__partition_attr] ])]
+			ds = ds[np.isin(ds.sa[self.__partition_attr].value, chunks)]
 			
 			return ds
 		else:
 			return dataset
 	
+	def _get_match_plans(self, dataset):
+		"""get the dicts of cached feature match plans for the current
+		training data, for matching ds1 to ds2 and ds2 to ds1"""
+		if self.__match_data is None:
+			#the match data is the training data, so nothing can be reused
+			return [{}, {}]
+		
+		#start over if the match data have changed. the match data are
+		#copied along with the training data, so compare their contents.
+		source = self._get_match_source(dataset)
+		h = hashlib.sha1()
+		h.update(np.ascontiguousarray(source.samples).data)
+		for attr in [self.__dataset_attr, self.__partition_attr, self.__match_partition_attr]:
+			if not attr is None:
+				h.update(pickle.dumps(source.sa[attr].value.tolist()))
+		if h.hexdigest() != self.__match_source:
+			self._reset_match_cache(h.hexdigest())
+		
+		chunks = self._get_match_chunks(dataset)
+		key = frozenset(chunks)
+		if not key in self.__match_plans:
+			self.__match_plans[key] = [{}, {}]
+		plans = self.__match_plans[key]
+		
+		#calculate the missing plans from the running sums
+		if self.__match_incremental:
+			attr = self.__match_partition_attr
+			if attr is None:
+				values = [None]
+			else:
+				values = np.unique(dataset.sa[attr].value)
+			
+			for val in values:
+				if not val in plans[0]:
+					r = self._get_match_correlation(source, chunks, val)
+					plans[0][val] = correlation_match_plan(r.T)
+					plans[1][val] = correlation_match_plan(r)
+		
+		return plans
+	
+	def _get_match_cell(self, source, chunk, val):
+		"""get the sufficient statistics of the match data samples with the
+		specified partition_attr and match_partition_attr values"""
+		key = (chunk, val)
+		if not key in self.__match_cells:
+			[md1, md2] = self._separate_datasets(source)
+			
+			x = []
+			for md in [md1, md2]:
+				samples = md.sa[self.__partition_attr].value == chunk
+				if not self.__match_partition_attr is None:
+					samples &= md.sa[self.__match_partition_attr].value == val
+				x.append(np.asarray(md.samples[samples], dtype=np.float64))
+			
+			if x[0].shape != x[1].shape:
+				raise Exception('the two match datasets do not have the same samples for %s=%s' % (self.__partition_attr, chunk))
+			
+			self.__match_cells[key] = [x[0].shape[0], np.sum(x[0], axis=0),
+				np.sum(x[1], axis=0), np.sum(x[0]**2, axis=0),
+				np.sum(x[1]**2, axis=0), np.dot(x[0].T, x[1])]
+		
+		return self.__match_cells[key]
+	
+	def _get_match_correlation(self, source, chunks, val):
+		"""calculate the correlation between the features of match datasets
+		1 and 2 over the specified chunks, excluding samples with
+		match_partition_attr value val"""
+		if self.__match_partition_attr is None:
+			values = [None]
+		else:
+			values = np.unique(source.sa[self.__match_partition_attr].value)
+		cells = set([ (c, v) for c in chunks for v in values if v != val or v is None ])
+		
+		#update the running sums for val by adding the cells that entered and
+		#subtracting the cells that left
+		if val in self.__match_sums:
+			cells_old, sums = self.__match_sums[val]
+			add = cells - cells_old
+			sub = cells_old - cells
+			
+			if len(add) + len(sub) >= len(cells):
+				sums = None
+		else:
+			sums = None
+		
+		if sums is None:
+			add = cells
+			sub = set()
+			sums = [ np.zeros_like(x) for x in self._get_match_cell(source, *next(iter(cells))) ]
+		
+		for cell in add:
+			for s, x in zip(sums, self._get_match_cell(source, *cell)):
+				s += x
+		for cell in sub:
+			for s, x in zip(sums, self._get_match_cell(source, *cell)):
+				s -= x
+		
+		self.__match_sums[val] = (cells, sums)
+		
+		#correlation from the sums
+		n, s1, s2, ss1, ss2, c12 = sums
+		cov = c12 - np.outer(s1, s2)/n
+		v1 = ss1 - s1**2/n
+		v2 = ss2 - s2**2/n
+		
+		return cov / np.sqrt(np.outer(v1, v2))
+	
 	def _set_retrainable(self, value, force=False):
 		self.__clf2._set_retrainable(value, force=force)
 		super(MatchedDatasetCrossClassifier, self)._set_retrainable(value, force=force)		
@@ -1170,9 +2273,12 @@ class MatchedDatasetCrossClassifier(ProxyClassifier):
 			match_data = self._get_match_data(dataset)
 			[md1, md2] = self._separate_datasets(match_data)
 			
+			#get the cached match plans
+			[plans1, plans2] = self._get_match_plans(dataset)
+			
 			#reorder the features of ds1 and ds2
-			ds1 = feature_match(ds1, md2, x_match=md1, partition_attr=self.__match_partition_attr)
-			ds2 = feature_match(ds2, md1, x_match=md2, partition_attr=self.__match_partition_attr)
+			ds1 = feature_match(ds1, md2, x_match=md1, partition_attr=self.__match_partition_attr, plans=plans1)
+			ds2 = feature_match(ds2, md1, x_match=md2, partition_attr=self.__match_partition_attr, plans=plans2)
 		
 		#train the first classifier on ds1
 		super(MatchedDatasetCrossClassifier, self)._train(ds1)
@@ -1217,6 +2323,46 @@ class MatchedDatasetCrossClassifier(ProxyClassifier):
 		super(MatchedDatasetCrossClassifier, self)._untrain()
 
 
+class WarmSMLR(SMLR):
+	"""SMLR that can start training from the weights of a previous fit (e.g.
+	the previous classifier along a regularization path) rather than from
+	zero weights"""
+	warm = None #the weights (including the bias) to start the next fit from
+	
+	@classmethod
+	def from_smlr(cls, clf):
+		"""construct a WarmSMLR with the same parameters as an SMLR"""
+		return cls(**dict([(key, clf.params[key].value) for key in clf.params.keys()]))
+	
+	def get_weights_all(self):
+		"""get the trained weights, including the bias"""
+		if self.params.has_bias:
+			return np.vstack((self.weights, self.biases[np.newaxis]))
+		else:
+			return self.weights
+	
+	def _train(self, dataset):
+		if self.warm is None:
+			return SMLR._train(self, dataset)
+		
+		#only the python stepwise regression can start from given weights
+		implementation = self.params.implementation
+		self.params.implementation = 'Python'
+		try:
+			return SMLR._train(self, dataset)
+		finally:
+			self.params.implementation = implementation
+	
+	def _python_stepwise_regression(self, w, X, XY, Xw, E, auto_corr, lambda_over_2_auto_corr, S, M, *args, **kwargs):
+		if self.warm is not None and self.warm.shape == w.shape:
+			w[:] = self.warm
+			Xw[:] = np.dot(X, w)
+			E[:] = np.exp(Xw)
+			S[:] = np.sum(E, axis=1) + (M - w.shape[1])
+		
+		return SMLR._python_stepwise_regression(self, w, X, XY, Xw, E, auto_corr, lambda_over_2_auto_corr, S, M, *args, **kwargs)
+
+
 class NestedClassifier(Classifier):
 	"""nested classifier that uses its own internal cross validation to
 	choose the best of a set of classifiers on each fold"""
@@ -1224,8 +2370,12 @@ class NestedClassifier(Classifier):
 	best_clf_idx = None
 	
 	partitioner = None
+	cores = 1
+	path = False
+	
+	_path_clfs = None #the classifiers to train along the path
 	
-	def __init__(self, clfs, partitioner, *args, **kwargs):
+	def __init__(self, clfs, partitioner, cores=1, path=False, *args, **kwargs):
 		Classifier.__init__(self, *args, **kwargs)
 		
 		self.clfs = clfs if isinstance(clfs,list) else [clfs]
@@ -1234,26 +2384,133 @@ class NestedClassifier(Classifier):
 			clf.ca = self.ca
 		
 		self.partitioner = partitioner
+		self.cores = cores
+		self.path = path and self._get_path_parameter() is not None
+		
+		#SMLR can only be warm started by WarmSMLR
+		if self.path and isinstance(self.clfs[0], SMLR):
+			self._path_clfs = [WarmSMLR.from_smlr(clf) for clf in self.clfs]
+			
+			for clf in self._path_clfs:
+				clf.ca = self.ca
+		else:
+			self._path_clfs = self.clfs
+	
+	def _get_path_parameter(self):
+		"""if the classifiers are all SMLR or all the same warm-startable
+		scikit-learn estimator, and they only differ in one parameter (e.g. a
+		regularization path), get the name of that parameter"""
+		clf = self.clfs[0]
+		
+		if isinstance(clf, SMLR):
+			params = [dict([(key, c.params[key].value) for key in c.params.keys()]) for c in self.clfs]
+		elif isinstance(clf, SKLLearnerAdapter) and 'warm_start' in clf._skl_learner.get_params():
+			params = [c._skl_learner.get_params() for c in self.clfs]
+		else:
+			return None
+		
+		if not all([type(c) is type(clf) for c in self.clfs]):
+			return None
+		if isinstance(clf, SKLLearnerAdapter) and not all([type(c._skl_learner) is type(clf._skl_learner) for c in self.clfs]):
+			return None
+		
+		keys = [key for key in params[0] if not all([np.array_equal(p[key], params[0][key]) for p in params[1:]])]
+		
+		return keys[0] if len(keys) == 1 else None
+	
+	def __train_warm(self, clf, ds, warm=None):
+		"""train clf, starting from the solution warm of the previous classifier
+		along the path. returns the solution to start the next one from."""
+		if isinstance(clf, WarmSMLR):
+			clf.warm = warm
+			try:
+				clf.train(ds)
+			finally:
+				clf.warm = None
+			
+			return clf.get_weights_all()
+		else:
+			#scikit-learn estimators warm start from their own fitted
+			#attributes
+			learner = clf._skl_learner
+			warm_start = learner.warm_start
+			
+			if warm is not None:
+				for key, val in vars(warm).iteritems():
+					if key.endswith('_') and not key.startswith('_'):
+						setattr(learner, key, val)
+			
+			learner.set_params(warm_start=warm is not None)
+			try:
+				clf.train(ds)
+			finally:
+				learner.set_params(warm_start=warm_start)
+			
+			return learner
 	
-	def __CV(self, clf, ds):
+	def __CV_path(self, train, test):
+		"""train the classifiers on a single fold as a path, with each one
+		starting from the solution of the previous one, and get their errors.
+		the warm-started fits stop at different points than independent fits
+		would, so the errors (and sometimes the chosen classifier) can differ
+		from those of __CV."""
+		err = []
+		
+		warm = None
+		for clf in self._path_clfs:
+			warm = self.__train_warm(clf, train, warm)
+			err.append(np.mean(np.asarray(clf.predict(test)) != test.targets))
+		
+		return err
+	
+	def __CV(self, clf, folds):
 		"""perform cross-validation to determine how well the given
-		classifier performs with the given dataset"""
+		classifier performs with the given folds"""
 		#status('testing %s' % (clf), indent=1, debug='all')
 		
 		#classify
-		cv = CrossValidation(clf,self.partitioner)
-		res = cv(ds)
+		err = []
+		for train, test in folds:
+			clf.train(train)
+			err.append(np.mean(np.asarray(clf.predict(test)) != test.targets))
 		
 		#return the average error across folds
-		return np.mean(res.samples)
+		return np.mean(err)
 	
 	def _train(self, ds):
 		#status('training', debug='all')
 		
-		#find the best classifier for this dataset
-		err = [self.__CV(clf, ds) for clf in self.clfs]
+		#the folds only depend on the dataset, so every classifier is tested
+		#on the same ones
+		folds = get_folds(self.partitioner, ds)
+		
+		#find the best classifier for this dataset. each classifier starts
+		#from the same random state, and the state is restored afterward, so
+		#the outcome doesn't depend on how the classifiers are distributed
+		#among the cores.
+		rng_state = (np.random.get_state(), random.getstate())
+		
+		def test_clf(clf):
+			np.random.set_state(rng_state[0])
+			random.setstate(rng_state[1])
+			
+			return self.__CV(clf, folds)
+		
+		def test_path(fold):
+			np.random.set_state(rng_state[0])
+			random.setstate(rng_state[1])
+			
+			return self.__CV_path(*fold)
+		
+		if self.path:  # one path per fold
+			err = [np.mean(e) for e in zip(*parallel_map(test_path, folds, cores=self.cores))]
+		else:
+			err = parallel_map(test_clf, self.clfs, cores=self.cores)
 		self.best_clf_idx = np.where(err == min(err))[0][0]
 		
+		np.random.set_state(rng_state[0])
+		random.setstate(rng_state[1])
+		
 		#status('chose %s' % (self.clfs[self.best_clf_idx]), indent=1, debug='all')
 		
 		#use it to train on the full dataset
@@ -1284,13 +2541,14 @@ class CaptureSelector(ElementSelector):
 	
 	def reset(self):
 		"""empty the selected array"""
-		self.selected.samples[:] = 0
+		self.selected[:] = 0
 		self.selection_count = 0
 		
 	def save(self, mask=None, indent=0):
-		"""save the selected voxels"""
-		self.selected.samples /= self.selection_count
-		selected = save_dataset(self.param, 'selected', self.selected)
+		"""save the selected voxels. this just records the selection counts,
+		which export_selected maps back into the mask's space once the whole
+		mask has been classified."""
+		selected = SelectionCount(self.param['classification_name'], self.selected.copy(), self.selection_count)
 		
 		self.reset()
 		
@@ -1301,7 +2559,7 @@ class CaptureSelector(ElementSelector):
 		
 		self.param = param
 		self.selector = selector
-		self.selected = ds[0].copy()
+		self.selected = np.zeros(ds.nfeatures, dtype=np.int32)
 		
 		self.reset()
 	
@@ -1310,11 +2568,268 @@ class CaptureSelector(ElementSelector):
 		selected = self.selector(seq)
 		
 		#save a record of what was selected
-		self.selected.samples[0,selected] += 1
+		self.selected[selected] += 1
 		self.selection_count += 1
 		
 		return selected
 
+class SelectionCount(object):
+	"""the number of times each feature was selected during a classification
+	(see CaptureSelector)"""
+	name = None #the classification name
+	count = None #the selection count of each feature
+	selection_count = 0 #the number of selections
+	
+	def __init__(self, name, count, selection_count):
+		self.name = name
+		self.count = count
+		self.selection_count = selection_count
+
+class SensitivityCapture(object):
+	"""a CrossValidation callback that records the sensitivities of each
+	fold's trained classifier, so the folds don't need to be retrained to
+	compute sensitivities"""
+	analyzer = None
+	sensitivities = None
+	
+	def __init__(self, clf):
+		self.analyzer = clf.get_sensitivity_analyzer(force_train=False, postproc=maxofabs_sample())
+		self.sensitivities = []
+	
+	def __call__(self, data, node, result):
+		self.sensitivities.append(self.analyzer(data))
+	
+	def get(self):
+		"""get the captured sensitivities as a Dataset with one sample per
+		fold"""
+		return vstack(self.sensitivities)
+
+
+class PartitionTailSelector(object):
+	"""mixin for TailSelectors that finds the tail with np.argpartition instead
+	of sorting the whole sequence"""
+	def _call(self, seq):
+		seq = np.asarray(seq)
+		
+		len_seq = len(seq)
+		nelements = min(self._get_n_elements(seq), len_seq)
+		
+		def lower(k):
+			"""indices of the k smallest elements"""
+			if k <= 0:
+				return np.array([], dtype=int)
+			elif k >= len_seq:
+				return np.arange(len_seq)
+			else:
+				return np.argpartition(seq, k-1)[:k]
+		
+		def upper(k):
+			"""indices of the k largest elements"""
+			if k <= 0:
+				return np.array([], dtype=int)
+			elif k >= len_seq:
+				return np.arange(len_seq)
+			else:
+				return np.argpartition(seq, len_seq-k)[len_seq-k:]
+		
+		tail = self._TailSelector__tail
+		if self.mode == 'discard' and tail == 'upper':
+			good_ids = lower(len_seq - nelements)
+			self.ca.ndiscarded = nelements
+		elif self.mode == 'discard' and tail == 'lower':
+			good_ids = upper(len_seq - nelements)
+			self.ca.ndiscarded = nelements
+		elif self.mode == 'select' and tail == 'upper':
+			good_ids = upper(nelements)
+			self.ca.ndiscarded = len_seq - nelements
+		else:
+			good_ids = lower(nelements)
+			self.ca.ndiscarded = len_seq - nelements
+		
+		if self._TailSelector__sort:
+			good_ids.sort()
+		
+		return list(good_ids)
+
+class FractionTailPartitionSelector(PartitionTailSelector, FractionTailSelector):
+	"""FractionTailSelector that uses np.argpartition"""
+	pass
+
+class FixedNElementTailPartitionSelector(PartitionTailSelector, FixedNElementTailSelector):
+	"""FixedNElementTailSelector that uses np.argpartition"""
+	pass
+
+
+def add_sample_index(ds):
+	"""get a shallow copy of a dataset with a sample_idx sample attribute that
+	gives the index of each sample, so CachedOneWayAnova can tell which
+	samples end up in each fold"""
+	ds = ds.copy(deep=False)
+	ds.sa['sample_idx'] = np.arange(ds.nsamples)
+	
+	return ds
+
+class CachedOneWayAnova(OneWayAnova):
+	"""OneWayAnova that calculates F-scores from a table of the per-chunk,
+	per-target sums and sums of squares of each feature of a dataset. the
+	training set of each fold is a subset of that dataset, so the table is
+	built once and each fold only needs a sum over the table's rows (plus a
+	pass over the samples of any chunk/target cells that are only partly in
+	the training set, e.g. because of the target balancer). datasets that
+	can't be matched to the table (e.g. with permuted targets) get the
+	normal calculation.
+	
+	the samples of the dataset are identified by the sample_idx sample
+	attribute, which it should get from add_sample_index."""
+	_ds = None
+	
+	_targets = None #the target of each sample
+	_cell = None #the chunk/target cell of each sample
+	_cell_target = None #the target index of each cell
+	_count = None #the number of samples in each cell
+	_sum = None #nCell x nFeature sums
+	_sum2 = None #nCell x nFeature sums of squares
+	_target_sum = None #nTarget x nFeature sums over all cells
+	_target_sum2 = None #nTarget x nFeature sums of squares over all cells
+	
+	def __init__(self, ds, *args, **kwargs):
+		OneWayAnova.__init__(self, *args, **kwargs)
+		
+		self._ds = ds
+	
+	def _build(self):
+		"""build the table of sums"""
+		ds = self._ds
+		table = TargetTable(ds)
+		
+		self._targets = table.targets
+		self._cell = table.chunk_idx*len(table.targets) + table.target_idx
+		self._cell_target = np.tile(np.arange(len(table.targets)), len(table.chunks))
+		self._count = np.reshape(table.count, -1)
+		
+		#sum the samples of each cell
+		order = np.argsort(self._cell, kind='mergesort')
+		X = np.asarray(ds.samples, dtype=np.float64)[order]
+		
+		cells, start = np.unique(self._cell[order], return_index=True)
+		
+		self._sum = np.zeros((len(self._count), ds.nfeatures))
+		self._sum2 = np.zeros((len(self._count), ds.nfeatures))
+		self._sum[cells] = np.add.reduceat(X, start, axis=0)
+		self._sum2[cells] = np.add.reduceat(X*X, start, axis=0)
+		
+		self._target_sum = np.zeros((len(table.targets), ds.nfeatures))
+		self._target_sum2 = np.zeros((len(table.targets), ds.nfeatures))
+		for t in range(len(table.targets)):
+			self._target_sum[t] = np.sum(self._sum[self._cell_target==t], axis=0)
+			self._target_sum2[t] = np.sum(self._sum2[self._cell_target==t], axis=0)
+		
+		self._ds = None
+	
+	def _call(self, dataset):
+		if not 'sample_idx' in dataset.sa:
+			return OneWayAnova._call(self, dataset)
+		
+		if self._sum is None:
+			self._build()
+		
+		#make sure the dataset's samples and targets match the table
+		if dataset.nfeatures != self._sum.shape[1]:
+			return OneWayAnova._call(self, dataset)
+		
+		idx = dataset.sa.sample_idx
+		if np.max(idx) >= len(self._cell) or len(np.unique(idx)) != len(idx):
+			return OneWayAnova._call(self, dataset)
+		elif not np.array_equal(dataset.sa[self.get_space()].value, self._targets[self._cell_target[self._cell[idx]]]):
+			return OneWayAnova._call(self, dataset)
+		
+		#which cells are completely in the dataset
+		cell = self._cell[idx]
+		count = np.bincount(cell, minlength=len(self._count))
+		complete = (count == self._count) & (count > 0)
+		
+		#sums for each target from the complete cells, i.e. the totals minus
+		#the cells that aren't complete
+		target_count = len(self._targets)
+		n = np.bincount(self._cell_target[cell], minlength=target_count).astype(np.float64)
+		s = self._target_sum.copy()
+		s2 = self._target_sum2.copy()
+		
+		for c in np.nonzero(~complete & (self._count > 0))[0]:
+			s[self._cell_target[c]] -= self._sum[c]
+			s2[self._cell_target[c]] -= self._sum2[c]
+		
+		#plus the samples in the partial cells
+		partial = ~complete[cell]
+		if np.any(partial):
+			X = np.asarray(dataset.samples[partial], dtype=np.float64)
+			target_partial = self._cell_target[cell[partial]]
+			
+			for t in np.unique(target_partial):
+				s[t] += np.sum(X[target_partial==t], axis=0)
+				s2[t] += np.sum(X[target_partial==t]**2, axis=0)
+		
+		#F-scores, as in OneWayAnova
+		present = n > 0
+		n, s, s2 = n[present], s[present], s2[present]
+		
+		na = len(n)
+		bign = np.sum(n)
+		
+		sostot = np.sum(s, axis=0)**2 / bign
+		sstot = np.sum(s2, axis=0) - sostot
+		ssbn = np.sum(s**2 / n[:,np.newaxis], axis=0) - sostot
+		sswn = sstot - ssbn
+		
+		dfbn = na - 1
+		dfwn = bign - na
+		
+		f = (ssbn / float(dfbn)) / (sswn / float(dfwn))
+		f[np.isnan(f)] = 0
+		
+		return Dataset(f[np.newaxis], fa={'fprob': scipy.special.fdtrc(dfbn, dfwn, f)})
+
+
+class TargetTable(object):
+	"""indexed table of the target and chunk of each sample in a dataset, for
+	selecting samples and counting targets without looping over samples"""
+	targets = None #the unique targets
+	chunks = None #the unique chunks
+	
+	target_idx = None #the index of each sample's target in targets
+	chunk_idx = None #the index of each sample's chunk in chunks
+	
+	count = None #nChunk x nTarget table of sample counts
+	
+	def select(self, targets=None, chunks=None):
+		"""get a boolean array of the samples with any of the specified
+		targets and chunks"""
+		samples = np.ones(len(self.target_idx), dtype=bool)
+		
+		if targets is not None:
+			samples &= np.isin(self.targets, targets)[self.target_idx]
+		if chunks is not None:
+			samples &= np.isin(self.chunks, chunks)[self.chunk_idx]
+		
+		return samples
+	
+	def target_count(self):
+		"""get the number of samples of each target"""
+		return np.sum(self.count, axis=0)
+	
+	def complement_count(self):
+		"""get an nChunk x nTarget table of the number of samples of each
+		target in each chunk's complement"""
+		return self.target_count() - self.count
+	
+	def __init__(self, ds):
+		self.targets, self.target_idx = np.unique(ds.sa.targets, return_inverse=True)
+		self.chunks, self.chunk_idx = np.unique(ds.sa.chunks, return_inverse=True)
+		
+		count = np.bincount(self.chunk_idx*len(self.targets) + self.target_idx,
+				minlength=len(self.chunks)*len(self.targets))
+		self.count = np.reshape(count, (len(self.chunks), len(self.targets)))
+
 
 def preprocess_data_one(param, ds, show_status=True):
 	"""preprocess a single dataset"""
@@ -1327,8 +2842,8 @@ def preprocess_data_one(param, ds, show_status=True):
 		#later want to include them in matching)
 		targets = param['target_subset']
 		if param['target_blank']:
-			targets = targets + [param['target_blank']]
-		dsfm = dsfm[array([ trg in targets for trg in dsfm.sa.targets ])]
+			targets = targets + force_list(param['target_blank'])
+		dsfm = dsfm[TargetTable(dsfm).select(targets=targets)]
 		
 		ds.a['feature_match_data'] = dsfm
 	
@@ -1364,7 +2879,7 @@ def preprocess_data_one(param, ds, show_status=True):
 		
 		#keep only the targets we are interested in
 		status('including targets: %s' % (", ".join(param['target_subset'])), indent=1, debug='all', show=show_status)
-		ds = ds[array([ trg in param['target_subset'] for trg in ds.sa.targets ])]
+		ds = ds[TargetTable(ds).select(targets=param['target_subset'])]
 		
 		#average samples of the same target within each chunk (and dataset)
 		if param['average']:
@@ -1391,7 +2906,12 @@ def preprocess_data(param, ds):
 		status('including targets: %s' % (", ".join(targets)), indent=1, debug='all')
 	
 		#compute the directed connectivity patterns
-		ds = compute_directed_connectivity_patterns(dsp[0], dsp[1], lags=param['dcclassify_lags'], targets=targets)
+		ds = compute_directed_connectivity_patterns(dsp[0], dsp[1],
+				lags=param['dcclassify_lags'],
+				lag_select=param['dcclassify_lag_select'],
+				targets=targets,
+				memmap=param['dcclassify_memmap']
+				)
 	else: #just stack the data
 		ds = vstack(dsp)
 	
@@ -1399,20 +2919,23 @@ def preprocess_data(param, ds):
 	if param['matchedcrossclassify'] and param['match_features']:
 		ds.a['feature_match_data'] = vstack([d.a.feature_match_data for d in dsp])
 	
+	return ds
+
+def check_target_balance(param, ds):
+	"""determine whether we need to use the target balancer"""
 	#make sure we should actually do target balancing
 	param['do_target_balancer'] = False
 	if notfalse(param['target_balancer']):
-		#check whether each chunk's complement has the same number of each target
-		for chunk in ds.uniquechunks:
-			#get the number of each target in the complement
-			chunk_targets = list(ds.targets[ds.chunks != chunk])
-			target_count = [chunk_targets.count(trg) for trg in ds.uniquetargets]
+		table = TargetTable(ds)
 		
+		#check whether each chunk's complement has the same number of each target
+		complement_count = table.complement_count()
+		for chunk, target_count in zip(table.chunks, complement_count):
 			#make sure the complement has all the targets
-			target_zero = np.array(target_count) == 0
+			target_zero = target_count == 0
 			if np.any(target_zero):
 				raise Exception("The following target(s) are not in chunk %d's complement: %s" %
-					(chunk, ", ".join(list(ds.uniquetargets[target_zero]))))
+					(chunk, ", ".join(list(table.targets[target_zero]))))
 			
 			#unequal numbers of targets, so yep
 			if len(np.unique(target_count)) != 1:
@@ -1423,7 +2946,7 @@ def preprocess_data(param, ds):
 		#do one last quick and dirty check to see if targets are unbalanced
 		#across the whole dataset
 		if not param['do_target_balancer'] and isinstance(param['partitioner'],NFoldPartitioner) and param['partitioner'].cvtype > 1:
-			target_count = [ds.targets.count(trg) for trg in ds.uniquetargets]
+			target_count = table.target_count()
 			if len(np.unique(target_count)) != 1:
 				status('unbalanced targets, using target balancer', indent=1, debug='all')
 				param['do_target_balancer'] = True
@@ -1432,14 +2955,127 @@ def preprocess_data(param, ds):
 			status('target balancer selected but not needed', indent=1, debug='all')
 	else:
 		status('target balancer not selected', indent=1, debug='all')
+
+def file_signature(path):
+	"""identify a file by its path, size, and modification time"""
+	stat = os.stat(path)
+	return [os.path.abspath(path), stat.st_size, stat.st_mtime]
+
+def get_preprocess_signature(param, mask=None):
+	"""get a json-serializable description of everything that determines the
+	outcome of data preprocessing"""
+	with open(param['path_attribute'], 'rb') as f:
+		attr_hash = hashlib.sha1(f.read()).hexdigest()
+	
+	if mask is None:
+		mask_hash = None
+	else:
+		#voxel coordinates, so the hash doesn't depend on the feature space
+		mask_voxels = np.ascontiguousarray(mask.fa.voxel_indices[mask.samples[0]])
+		mask_hash = hashlib.sha1(mask_voxels).hexdigest()
+	
+	return {
+		'data':					[file_signature(path) for path in force_list(param['path_data'])],
+		'attribute':			attr_hash,
+		'sample_attr':			param['sample_attr'],
+		'mask':					mask_hash,
+		'nan_remove':			param['nan_remove'],
+		'zscore':				param['zscore'],
+		'spatiotemporal':		param['spatiotemporal'],
+		'target_subset':		sorted(param['target_subset']),
+		'target_blank':			param['target_blank'],
+		'average':				param['average'],
+		'dcclassify':			param['dcclassify'],
+		'dcclassify_lags':		param['dcclassify_lags'],
+		'dcclassify_lag_select':	param['dcclassify_lag_select'],
+		'dcclassify_memmap':	param['dcclassify_memmap'],
+		'matchedcrossclassify':	param['matchedcrossclassify'],
+		'match_features':		param['match_features'],
+	}
+
+def get_classification_key(param, mean_control=False):
+	"""get a tuple that identifies the current classification within the
+	analysis"""
+	return (
+		param['mask_name'],
+		param['mask_bootstrap_idx'],
+		param['dc_lag'],
+		param['classification_name'],
+		mean_control,
+		)
+
+def get_classification_signature(param):
+	"""get a json-serializable description of everything other than the
+	preprocessed data that determines the outcome of a classification"""
+	return {
+		'classifier':			[clf.__repr__() for clf in param['classifier']],
+		'partitioner':			param['partitioner'].__repr__(),
+		'target_balancer':		param['target_balancer'] if param['do_target_balancer'] else None,
+		'selection':			param['selection'],
+		'save_selected':		param['save_selected'] and param['selection'] != 1,
+		'sensitivities':		param['sensitivities'],
+		'permutations':			param['permutations'],
+		'permutation_stop':		param['permutation_stop'],
+		'permutation_h':		param['permutation_h'],
+		'permutation_alpha':	param['permutation_alpha'],
+		'permutation_confidence':	param['permutation_confidence'],
+		'match_include_blank':	param['match_include_blank'],
+		'seed':					param['seed'],
+	}
+
+def get_checkpoint_fingerprint(param, mask=None):
+	"""get the fingerprint that ties checkpointed classifications to the
+	current data, mask subset, and parameters"""
+	signature = {
+		'preprocess':	get_preprocess_signature(param, mask),
+		'classify':		get_classification_signature(param),
+	}
+	
+	return hashlib.sha1(json.dumps(signature, sort_keys=True)).hexdigest()
+
+def get_preprocessed_data(param, data, mask=None, indent=0):
+	"""get the masked, preprocessed dataset, from the dataset cache if
+	possible"""
+	cache = param['cache']
+	
+	ds = None
+	if cache is not None:
+		key = cache.get_key(get_preprocess_signature(param, mask))
+		
+		ds = cache.load(key)
+		if ds is not None:
+			status('loaded preprocessed data from cache (%s)' % (key), indent=indent, debug='all')
+	
+	if ds is None:
+		ds = data()
+		
+		#apply the mask
+		if mask is not None:
+			ds = ds[:,mask.samples[0]]
+		
+		#preprocess the data
+		ds = preprocess_data(param, ds)
+		
+		if cache is not None:
+			cache.save(key, ds)
+	
+	check_target_balance(param, ds)
 	
 	return ds
 
-def get_mask_subset(mask, subset_count):
-	"""randomly choose a subset of voxels in a mask"""
+def get_mask_bootstrap_plan(param, mask, bootstrap_count):
+	"""randomly choose the voxel subset of each of a mask's bootstrap
+	iterations. the subsets are drawn from a random stream that depends only
+	on the seed and the mask name, so they are the same from run to run."""
+	rng = get_rng(param, 'mask_bootstrap', mask.a.name)
+	
+	return [rng.choice(mask.a.idx, param['mask_size_min'], replace=False) for bs in range(bootstrap_count)]
+
+def get_mask_subset(mask, idx):
+	"""get the subset of a mask that includes only the specified voxels"""
 	mask = mask.copy()
 	
-	mask.a['idx'] = random.sample(mask.a.idx, subset_count)
+	mask.a['idx'] = idx
 	mask.a['size'] = len(mask.a.idx)
 	
 	mask.samples[:] = False
@@ -1447,14 +3083,24 @@ def get_mask_subset(mask, subset_count):
 	
 	return mask
 
-def get_current_mask(param, result, mask, bootstrap=None):
-	"""get either the whole mask or a random subset if we are bootstrapping"""
-	if bootstrap is not None:
-		mask = get_mask_subset(mask,param['mask_size_min'])
+def get_current_mask(param, result, mask, subset=None):
+	"""get either the whole mask or a subset if we are bootstrapping"""
+	if subset is not None:
+		mask = get_mask_subset(mask, subset)
 		result['mask_bootstrap_subset'] = mask.a.idx
 	
 	return mask
 
+def mask_subset_is_slice(param):
+	"""determine whether preprocessing a mask subset is equivalent to
+	preprocessing the whole mask and then selecting the subset's features.
+	this is the case unless preprocessing mixes features (nan removal,
+	spatiotemporal and directed connectivity datasets, feature matching)."""
+	return (param['nan_remove'] == 'none' and
+			not param['spatiotemporal'] and
+			not param['dcclassify'] and
+			not (param['matchedcrossclassify'] and param['match_features']))
+
 
 def get_partitioner(param, indent=0):
 	"""construct the partitioner"""
@@ -1475,10 +3121,18 @@ def get_partitioner(param, indent=0):
 	
 	return partitioner
 
-def get_classifier(param, ds, partitioner, mean_control, indent=0):
+def get_classifier(param, ds, partitioner, mean_control, seed=None, indent=0):
 	"""construct the classifier"""
-	#the list of classifiers
-	clf = param['classifier']
+	#the list of classifiers. these are copies, so seeding them doesn't change
+	#the classifiers that every classification shares (and that go into the
+	#checkpoint signature).
+	clf = [copy.deepcopy(c) for c in param['classifier']]
+	
+	#some classifiers (e.g. SMLR) have their own seed parameter
+	if seed is not None:
+		for c in clf:
+			if 'seed' in c.params:
+				c.params.seed = seed
 	
 	status('base classifier(s): %s' % (",".join([c.__repr__() for c in clf])), indent=indent, debug='all')
 	
@@ -1486,7 +3140,7 @@ def get_classifier(param, ds, partitioner, mean_control, indent=0):
 	param['nested_clf'] = len(clf) > 1
 	if param['nested_clf']:
 		status('using nested classifier', indent=indent+1, debug='all')
-		clf = NestedClassifier(clf, partitioner)
+		clf = NestedClassifier(clf, partitioner, cores=param['cores'], path=param['nested_path'])
 		
 		nested_ca = clf.ca
 	else:
@@ -1508,10 +3162,10 @@ def get_classifier(param, ds, partitioner, mean_control, indent=0):
 		#get the actual selector
 		if param['selection'] < 1:
 			status('fraction selector (%f)' % (param['selection']), indent=indent+2, debug='all')
-			selector_fcn = FractionTailSelector
+			selector_fcn = FractionTailPartitionSelector
 		else:
 			status('fixed n selector (%d)' % (param['selection']), indent=indent+2, debug='all')
-			selector_fcn = FixedNElementTailSelector
+			selector_fcn = FixedNElementTailPartitionSelector
 		selector = selector_fcn(
 					param['selection'],
 					mode='select',
@@ -1523,9 +3177,16 @@ def get_classifier(param, ds, partitioner, mean_control, indent=0):
 			status('capture selector', indent=indent+2, debug='all')
 			selector = CaptureSelector(param, ds, selector)
 		
+		#the F-scores of each fold can be calculated from per-chunk sums of
+		#the dataset, unless feature matching transforms the samples first
+		if param['matchedcrossclassify']:
+			anova = OneWayAnova(enable_ca=['raw_results'])
+		else:
+			anova = CachedOneWayAnova(ds, enable_ca=['raw_results'])
+		
 		#construct the feature selection classifier
 		fsel = SensitivityBasedFeatureSelection(
-				OneWayAnova(enable_ca=['raw_results']),
+				anova,
 				selector,enable_ca=['sensitivity']
 				)
 		clf = FeatureSelectionClassifier(clf, fsel)
@@ -1543,13 +3204,12 @@ def get_classifier(param, ds, partitioner, mean_control, indent=0):
 		if param['match_include_blank'] and param['target_blank']:
 			#what are the blank chunks?
 			ds_match = ds.a.feature_match_data
+			table = TargetTable(ds_match)
 			blank_targets = force_list(param['target_blank'])
-			ds_blank_targets = ds_match[array([ trg in blank_targets for trg in ds.sa.targets ])]
-			blank_chunks = ds_blank_targets.uniquechunks
+			blank_chunks = np.unique(ds_match.sa.chunks[table.select(targets=blank_targets)])
 			
 			#make sure there aren't to-be-classified targets in these chunks
-			ds_blank_chunks = ds_match[array([ chunk in blank_chunks for chunk in ds.sa.chunks ])]
-			set_target_blank_chunks = set(ds_blank_chunks.uniquetargets)
+			set_target_blank_chunks = set(np.unique(ds_match.sa.targets[table.select(chunks=blank_chunks)]))
 			set_target_subset = set(param['target_subset'])
 			set_both = set_target_blank_chunks.intersection(set_target_subset)
 			if len(set_both) > 0:
@@ -1558,11 +3218,12 @@ def get_classifier(param, ds, partitioner, mean_control, indent=0):
 			blank_chunks = None
 		
 		clf = MatchedDatasetCrossClassifier(clf, match_features=param['match_features'],
-				match_data='feature_match_data', partition_attr_append=blank_chunks)
+				match_data='feature_match_data', partition_attr_append=blank_chunks,
+				match_incremental=param['match_incremental'])
 	
 	return clf
 
-def get_cross_validator(param, clf, partitioner, indent=0):
+def get_cross_validator(param, clf, partitioner, mean_control=False, indent=0):
 	"""construct the CrossValidation object"""
 	#base keyword arguments for the cross validator
 	cv_kwargs = {
@@ -1574,36 +3235,242 @@ def get_cross_validator(param, clf, partitioner, indent=0):
 	if param['nested_clf']:
 		cv_kwargs['enable_ca'].append('training_stats')
 	
-	#enable permutation testing if specified
+	#average the fold accuracies if we will do a permutation test (see
+	#permutation_test)
 	if notfalse(param['permutations']):
 		status('enabling statistics with %d permutations' % (param['permutations']), indent=indent, debug='all')
 		
 		cv_kwargs['postproc'] = mean_sample()
+	
+	#capture the sensitivities of each fold's classifier as we go
+	if param['sensitivities'] and not mean_control:
+		cv_kwargs['callback'] = SensitivityCapture(clf)
+	
+	return CrossValidation(clf, partitioner, **cv_kwargs)
+
+def get_folds(partitioner, ds):
+	"""get a list of (train, test) Dataset pairs for each cross-validation
+	fold generated by partitioner"""
+	space = partitioner.get_space()
+	
+	folds = []
+	for pds in partitioner.generate(ds):
+		part = pds.sa[space].value
+		folds.append((pds[part==1], pds[part==2]))
+	
+	return folds
+
+def permute_fold_targets(folds, seed):
+	"""get the permuted training targets of each fold for one permutation"""
+	rng = np.random.RandomState(seed)
+	
+	return [rng.permutation(train.targets) for train,test in folds]
+
+def permutation_accuracy(clf, folds, seeds):
+	"""calculate the mean cross-validation accuracy of clf for each of a set
+	of permutations of the training targets
+	
+	Parameters
+	----------
+	clf : Classifier
+	  the classifier to evaluate. a copy is trained for the permutations.
+	folds : list
+	  the (train, test) Datasets of each fold (see get_folds)
+	seeds : list
+	  the random seed of each permutation (see permute_fold_targets)
+	
+	Returns
+	-------
+	accuracy : array
+	  the mean accuracy across folds of each permutation
+	"""
+	clf = copy.deepcopy(clf)
+	
+	accuracy = np.empty(len(seeds))
+	for idx,seed in enumerate(seeds):
+		targets = permute_fold_targets(folds, seed)
 		
-		repeater = Repeater(count=param['permutations'])
-		permutator = AttributePermutator(
-					'targets',
-					limit={'partitions': 1},
-					count=1
-					)
+		#for classifiers that use the global random number generators, so the
+		#result doesn't depend on how the permutations are batched
+		seed_rngs(seed)
 		
-		null_partitioner = ChainNode(
-						[partitioner, permutator],
-						space=partitioner.get_space()
-						)
+		acc = []
+		for (train, test), trg in zip(folds, targets):
+			train = train.copy(deep=False)
+			train.sa['targets'] = trg
+			
+			clf.train(train)
+			acc.append(np.mean(np.asarray(clf.predict(test)) == test.targets))
 		
-		null_cv = CrossValidation(
-				clf,
-				null_partitioner,
-				errorfx=cv_kwargs['errorfx'],
-				postproc=cv_kwargs['postproc']
-				)
+		accuracy[idx] = np.mean(acc)
+	
+	return accuracy
+
+def gnb_permutation_accuracy(clf, folds, seeds):
+	"""a vectorized version of permutation_accuracy for GNB classifiers. all
+	permutations of a fold are trained and tested at once."""
+	params = clf.params
+	
+	targets = [ permute_fold_targets(folds, seed) for seed in seeds ]
+	
+	acc = np.empty((len(seeds), len(folds)))
+	for idx_fold, (train, test) in enumerate(folds):
+		X = np.asarray(train.samples, dtype=np.float64)
+		T = np.asarray(test.samples, dtype=np.float64)
+		
+		#class index of each training sample in each permutation
+		labels = np.unique(train.targets)
+		lbl = np.array([ np.searchsorted(labels, trg[idx_fold]) for trg in targets ])
 		
-		distr_est = MCNullDist(repeater, tail='right', measure=null_cv)
+		#permutations don't change the number of samples per class
+		count = np.bincount(lbl[0], minlength=len(labels)).astype(np.float64)
+		priors = clf._get_priors(len(labels), len(X), count)
 		
-		cv_kwargs['null_dist'] = distr_est	
+		#nPermutation x nClass x nSample class membership
+		onehot = (lbl[:,np.newaxis,:] == np.arange(len(labels))[:,np.newaxis]).astype(np.float64)
+		
+		#class means and variances
+		means = np.dot(onehot, X) / count[:,np.newaxis]
+		resid = X - means[np.arange(len(seeds))[:,np.newaxis], lbl]
+		variances = np.einsum('pcs,psf->pcf', onehot, resid**2)
+		if params.common_variance:
+			variances[:] = np.sum(variances, axis=1, keepdims=True) / len(X)
+		else:
+			variances /= count[:,np.newaxis]
+		
+		#log likelihood of each test sample for each class. the normalization
+		#of GNB's estimates doesn't affect the predictions.
+		w = 1 / variances
+		lprob = -0.5 * (np.dot(w, (T**2).T)
+						- 2*np.einsum('pcf,sf->pcs', means*w, T)
+						+ np.sum(means**2 * w, axis=2)[:,:,np.newaxis])
+		lprob += -0.5 * np.sum(np.log(2*np.pi*variances), axis=2)[:,:,np.newaxis]
+		lprob += np.log(priors)[:,np.newaxis]
+		
+		prediction = labels[np.argmax(lprob, axis=1)]
+		acc[:,idx_fold] = np.mean(prediction == test.targets, axis=1)
 	
-	return CrossValidation(clf, partitioner, **cv_kwargs)
+	return np.mean(acc, axis=1)
+
+def get_permutation_stop(param, null, accuracy):
+	"""determine whether a sequential permutation test can stop
+	
+	Parameters
+	----------
+	param : Parameters
+	  the parameters (see permutation_stop in MVPAClassify.m)
+	null : array
+	  the permuted accuracies so far, in the order they were drawn
+	accuracy : float
+	  the observed mean accuracy
+	
+	Returns
+	-------
+	count : int
+	  the number of permutations after which the test stops, or None if it
+	  should continue
+	p : float
+	  the p-value at that point
+	"""
+	#number of permuted accuracies at least as high as the observed after
+	#each permutation
+	n = np.arange(1, len(null)+1)
+	k = np.cumsum(null >= accuracy)
+	
+	if param['permutation_stop'] == 'besag':
+		stop = np.flatnonzero(k >= param['permutation_h'])
+		if len(stop) > 0:
+			count = stop[0] + 1
+			return count, float(param['permutation_h'])/count
+	elif param['permutation_stop'] == 'alpha':
+		#clopper-pearson interval of the p-value
+		a = 1 - param['permutation_confidence']
+		with np.errstate(invalid='ignore'):
+			lower = np.where(k > 0, spstats.beta.ppf(a/2, k, n - k + 1), 0)
+			upper = np.where(k < n, spstats.beta.ppf(1 - a/2, k + 1, n - k), 1)
+		
+		stop = np.flatnonzero((upper < param['permutation_alpha']) | (lower > param['permutation_alpha']))
+		if len(stop) > 0:
+			count = stop[0] + 1
+			p = float(k[stop[0]])/count
+			return count, np.clip(p, 1.0/(count+2), (count+1.0)/(count+2))
+	
+	return None, None
+
+def permutation_test(param, clf, partitioner, ds, accuracy, rng=np.random, indent=0):
+	"""estimate the probability of the observed mean accuracy under the null
+	hypothesis by repeating the cross-validation with the training targets of
+	each fold permuted. the folds are generated once, and the permutations
+	are evaluated in batches, in parallel if param['cores'] > 1. if
+	param['permutation_stop'] is set, permutations are evaluated in rounds
+	until get_permutation_stop says the test can stop.
+	
+	Parameters
+	----------
+	param : Parameters
+	  the parameters
+	clf : Classifier
+	  the classifier used in the cross-validation
+	partitioner : Node
+	  the cross-validation partitioner
+	ds : Dataset
+	  the classified dataset
+	accuracy : float
+	  the observed mean accuracy
+	rng : RandomState, optional
+	  the random number generator to draw the permutation seeds from
+	
+	Returns
+	-------
+	p : float
+	  the fraction of permutations with a mean accuracy at least as high as
+	  the observed accuracy, clipped to [1/(N+2), (N+1)/(N+2)] as in
+	  PyMVPA's Nonparametric distribution
+	count : int
+	  the number of permutations performed
+	"""
+	count = param['permutations']
+	
+	folds = get_folds(partitioner, ds)
+	
+	#evaluate GNB permutations all at once
+	if type(clf) is GNB:
+		fcn = gnb_permutation_accuracy
+	else:
+		fcn = permutation_accuracy
+	
+	#the permutation seeds are drawn here so the results don't depend on how
+	#the permutations are split up
+	seeds = rng.randint(np.iinfo(np.int32).max, size=count)
+	
+	#number of permutations to evaluate between checks for stopping
+	if param['permutation_stop'] is None:
+		round_size = count
+	else:
+		round_size = max(PERMUTATION_ROUND_SIZE, 2*param['cores'])
+	
+	status('estimating null distribution with up to %d permutations (%s)' % (count, fcn.__name__), indent=indent, debug='all')
+	
+	clf.untrain()
+	null = np.zeros(0)
+	while len(null) < count:
+		seeds_round = seeds[len(null):len(null)+round_size]
+		
+		batch_count = max(1, min(len(seeds_round), 4*param['cores']))
+		batches = np.array_split(seeds_round, batch_count)
+		
+		null = np.concatenate([null] + parallel_map(lambda seeds: fcn(clf, folds, seeds), batches, cores=param['cores']))
+		
+		if param['permutation_stop'] is not None:
+			count_stop, p = get_permutation_stop(param, null, accuracy)
+			if count_stop is not None:
+				status('stopped after %d permutations' % (count_stop), indent=indent+1, debug='all')
+				return p, count_stop
+	
+	p = np.mean(null >= accuracy)
+	
+	return np.clip(p, 1.0/(count+2), (count+1.0)/(count+2)), count
+
 
 def get_targets(ds):
 	"""get an np.object array of the target names (so it ends up as a cell in
@@ -1634,12 +3501,7 @@ def get_classification_results(param, ds, res, cv, mean_control, indent=0):
 	if param['sensitivities'] and not mean_control:
 		status('computing sensitivities', indent=indent, debug='all')
 		
-		clf = cv.learner
-		partitioner = cv.generator
-		
-		sa = RepeatedMeasure(clf.get_sensitivity_analyzer(postproc=maxofabs_sample()),partitioner)
-		
-		sense = sa(ds)
+		sense = cv.callback.get()
 		if not np.all(sense == 0):
 			sense = l1_normed(sense)
 		
@@ -1651,7 +3513,10 @@ def get_classification_results(param, ds, res, cv, mean_control, indent=0):
 		result['accuracy']['mean'] = np.mean(result['accuracy']['all'])
 		result['accuracy'].pop('all')
 		
-		result['accuracy']['permutation_p'] = np.mean(cv.ca.null_prob.samples)
+		rng = get_rng(param, 'permutation', *get_classification_key(param, mean_control))
+		p, count = permutation_test(param, cv.learner, cv.generator, ds, result['accuracy']['mean'], rng=rng, indent=indent)
+		result['accuracy']['permutation_p'] = p
+		result['accuracy']['permutation_count'] = count
 	
 	return result
 	
@@ -1665,17 +3530,39 @@ def classify_one(param, ds, name, mean_control=False, indent=0):
 	else:
 		status('performing %s classification' % (name), indent=indent)
 	
+	#seed the random number generators used by the cross-validation (and the
+	#classifiers, see get_classifier)
+	seed = get_seed(param, 'classify', *get_classification_key(param, mean_control))
+	seed_rngs(seed)
+	
+	#index the samples for CachedOneWayAnova (see get_classifier)
+	if param['selection'] != 1:
+		ds = add_sample_index(ds)
+	
 	#construct the classification objects
 	partitioner = get_partitioner(param, indent=indent+1)
-	clf = get_classifier(param, ds, partitioner, mean_control, indent=indent+1)
-	cv = get_cross_validator(param, clf, partitioner, indent=indent+1)
+	clf = get_classifier(param, ds, partitioner, mean_control, seed=seed, indent=indent+1)
+	cv = get_cross_validator(param, clf, partitioner, mean_control=mean_control, indent=indent+1)
 	
-	#do the classification
-	status('classifying %s - min:%f, max:%f' % (str(ds.shape), np.min(ds.samples), np.max(ds.samples)), indent=indent+1, debug='all')
-	res = cv(ds)
+	#use the checkpointed result if we have one
+	checkpoint = param['checkpoint']
+	if checkpoint is not None and not param['force_each']:
+		result = checkpoint.load(param, mean_control=mean_control)
+	else:
+		result = None
 	
-	#get the results
-	result = get_classification_results(param, ds, res, cv, mean_control, indent=indent+1)
+	if result is not None:
+		status('loaded result from checkpoint', indent=indent+1)
+	else:
+		#do the classification
+		status('classifying %s - min:%f, max:%f' % (str(ds.shape), np.min(ds.samples), np.max(ds.samples)), indent=indent+1, debug='all')
+		res = cv(ds)
+		
+		#get the results
+		result = get_classification_results(param, ds, res, cv, mean_control, indent=indent+1)
+		
+		if checkpoint is not None:
+			checkpoint.save(param, result, mean_control=mean_control)
 	
 	#perform a control classification on just the mean of each sample
 	if not mean_control and param['mean_control']:
@@ -1683,9 +3570,68 @@ def classify_one(param, ds, name, mean_control=False, indent=0):
 	
 	return result
 
-def classify_mask(param, data, mask=None, mask_bootstrap_idx=None, indent=0):
-	"""perform the classification for a single mask"""
-	result = Result(param, mask=mask)
+def classify_dataset(param, ds, result, indent=0):
+	"""perform the classifications on a preprocessed dataset, storing the
+	results in result"""
+	#allway classification
+	if param['allway']:
+		result['allway'] = classify_one(param, ds, 'allway', indent=indent+1)
+	
+	#every two-way classification
+	if param['twoway']:
+		target_count = len(ds.uniquetargets)
+		
+		result['twoway'] = np.zeros((target_count, target_count), dtype=np.object)
+		
+		pairs = [(t1, t2) for t1 in range(0,target_count) for t2 in range(t1+1,target_count)]
+		
+		def classify_pair(pair):
+			#data subset only including the two current targets
+			target_sub = ds.uniquetargets[list(pair)]
+			ds_sub     = ds[np.isin(ds.targets, target_sub)]
+			
+			name = 'twoway: %s' % " vs ".join(target_sub)
+			
+			start_time = time.time()
+			result_pair = classify_one(param, ds_sub, name, indent=indent+1)
+			status('%s took %.2f s' % (name, time.time() - start_time), indent=indent+2)
+			
+			return result_pair
+		
+		result_pairs = parallel_map(classify_pair, pairs, cores=param['cores'])
+		
+		for (t1, t2), result_pair in zip(pairs, result_pairs):
+			result['twoway'][t1,t2] = result_pair
+	
+	return result
+
+def classify_mask(param, data, mask=None, mask_bootstrap_idx=None,
+	mask_subset=None, ds_mask=None, indent=0):
+	"""perform the classification for a single mask
+	
+	Parameters
+	----------
+	param : Parameters
+	  the parameters
+	data : Data
+	  the data
+	mask : Mask, optional
+	  the mask to classify
+	mask_bootstrap_idx : int, optional
+	  the index of the current mask bootstrap iteration
+	mask_subset : array, optional
+	  for mask bootstrap iterations, the voxels in the mask subset
+	ds_mask : Dataset, optional
+	  for mask bootstrap iterations, the preprocessed data from the whole
+	  mask, if the subset's data can be sliced from it (see
+	  mask_subset_is_slice)
+	
+	Returns
+	-------
+	result : Result
+	  the result, or a list of bootstrap iteration results
+	"""
+	result = Result(param, mask=mask, bootstrap=mask_bootstrap_idx)
 	
 	#should we actually do the analysis?
 	if not param['force_each'] and result.exists():
@@ -1694,10 +3640,7 @@ def classify_mask(param, data, mask=None, mask_bootstrap_idx=None, indent=0):
 	else:
 		status("%s doesn't exist." % (result.output_path), indent=indent, debug='all')
 	
-	ds = data()
-	mask = mask() if mask else mask
-	
-	param['mask_name'] = mask.a.name if mask else None
+	param['mask_name'] = mask.name if mask else None
 	param['mask_bootstrap_idx'] = mask_bootstrap_idx
 			
 	if mask:
@@ -1711,55 +3654,69 @@ def classify_mask(param, data, mask=None, mask_bootstrap_idx=None, indent=0):
 			do_mask_bootstrap = param['mask_balancer']=='bootstrap'
 			
 			if do_mask_bootstrap:
-				mask_size_min = mask.a.size == param['mask_size_min']
+				mask_size_min = mask().a.size == param['mask_size_min']
 				
 				if not mask_size_min:
 					status('mask bootstrap selected and needed', indent=indent+1, debug='all')
 					
 					bootstrap_count = param['mask_balancer_count']
-					return [classify_mask(
+					subsets = get_mask_bootstrap_plan(param, mask(), bootstrap_count)
+					
+					#preprocess the whole mask once if the bootstraps can use it
+					bootstrap_missing = param['force_each'] or not all([Result(param, mask=mask, bootstrap=bs).exists() for bs in range(bootstrap_count)])
+					if bootstrap_missing and mask_subset_is_slice(param):
+						ds_mask = get_preprocessed_data(param, data, mask(), indent=indent+1)
+					
+					def classify_bootstrap(bs):
+						return dict(classify_mask(
 							param,
-							ds,
+							data,
 							mask,
 							mask_bootstrap_idx=bs,
+							mask_subset=subsets[bs],
+							ds_mask=ds_mask,
 							indent=indent+1
-							) for bs in range(bootstrap_count)]
+							))
+					
+					return parallel_map(classify_bootstrap, range(bootstrap_count), cores=param['cores'])
 				else: status('mask bootstrap selected but not needed', indent=indent+1, debug='all')
 			else: status('mask bootstrap not selected', indent=indent+1, debug='all')
 		
 		#get the current mask subset
-		mask = get_current_mask(param, result, mask, bootstrap=mask_bootstrap_idx)
-			
-		#apply the mask
-		ds = ds[:,mask.samples[0]]
+		mask_full = mask()
+		mask = get_current_mask(param, result, mask_full, subset=mask_subset)
 	else:
 		status('classifying', indent=indent)
 	
-	#preprocess the data
-	ds = preprocess_data(param, ds)
-	
-	#allway classification
-	if param['allway']:
-		result['allway'] = classify_one(param, ds, 'allway', indent=indent+1)
-	
-	#every two-way classification
-	if param['twoway']:
-		target_count = len(ds.uniquetargets)
-		
-		result['twoway'] = np.zeros((target_count, target_count), dtype=np.object)
-		
-		for t1 in range(0,target_count):
-			for t2 in range(t1+1,target_count):
-				#data subset only including the two current targets
-				target_sub = ds.uniquetargets[[t1,t2]]
-				ds_sub     = ds[np.logical_or(*[ds.targets==trg for trg in target_sub])]
-				
-				name = 'twoway: %s' % " vs ".join(target_sub)
-				result['twoway'][t1,t2] = classify_one(param, ds_sub, name, indent=indent+1)
+	#get the masked, preprocessed data
+	if ds_mask is not None:
+		ds = ds_mask[:,mask.samples[0][mask_full.samples[0]]]
+	else:
+		ds = get_preprocessed_data(param, data, mask, indent=indent+1)
+	
+	if param['checkpoint'] is not None:
+		param['checkpoint_fingerprint'] = get_checkpoint_fingerprint(param, mask)
+	
+	#classify each lag order's directed connectivity patterns separately
+	if 'dc_lag' in ds.fa:
+		for lag in np.unique(ds.fa.dc_lag):
+			status('lag order %d' % (lag), indent=indent+1)
+			param['dc_lag'] = int(lag)
+			ds_lag = ds[:,ds.fa.dc_lag==lag]
+			result['lag%d' % (lag)] = classify_dataset(param, ds_lag, {}, indent=indent+1)
+			export_selected(param, ds_lag, result['lag%d' % (lag)])
+		param['dc_lag'] = None
+	else:
+		classify_dataset(param, ds, result, indent=indent)
+		export_selected(param, ds, result)
 	
 	#save the mask result
 	result.save(indent=1)
 	
+	#the checkpoints are no longer needed once the result is saved
+	if param['checkpoint'] is not None:
+		param['checkpoint'].clear(param['mask_name'], mask_bootstrap_idx)
+	
 	return result
 
 def classify(param, data, masks):
@@ -1767,8 +3724,29 @@ def classify(param, data, masks):
 	if masks: # ROI classification
 		result = Result(param)
 		
-		for mask in masks:
-			result[mask] = classify_mask(param, data, masks[mask])
+		mask_names = list(masks)
+		
+		if param['cores'] > 1 and len(mask_names) > 1:
+			status('classifying masks using %d cores' % (param['cores']), debug='all')
+			
+			#load everything before the workers are forked so they share it
+			data()
+			for mask in mask_names:
+				masks[mask]()
+		
+		def classify_one_mask(mask):
+			result_mask = classify_mask(param, data, masks[mask])
+			
+			#send back plain dicts so only the results need to be pickled
+			if isinstance(result_mask, list):
+				return [dict(res) for res in result_mask]
+			else:
+				return dict(result_mask)
+		
+		result_masks = parallel_map(classify_one_mask, mask_names, cores=param['cores'])
+		
+		for mask, result_mask in zip(mask_names, result_masks):
+			result[mask] = result_mask
 	else:  # whole-dataset classification
 		result = classify_mask(param, data)
 	
@@ -1776,18 +3754,214 @@ def classify(param, data, masks):
 	
 	result.save()
 	
+	#the run finished, so we don't need the checkpoint store anymore
+	if param['checkpoint'] is not None:
+		param['checkpoint'].remove()
+	
 	return result
 
-#read the parameters file
-param = Parameters(path=DBG_PATH_PARAM)
+def run(path_param=None):
+	"""run the classification analysis defined by a parameter file"""
+	#read the parameters file
+	param = Parameters(path=path_param)
+	
+	status('commence script execution!', debug='all')
+	
+	#get the masks and data objects
+	masks = Masks(param)
+	data = Data(param, masks.union)
+	
+	#classify!
+	result = classify(param, data, masks)
+	
+	status('script execution finished!', debug='all')
+	
+	return result
 
-status('commence script execution!', debug='all')
 
-#get the data and masks objects
-data = Data(param)
-masks = Masks(param)
+class JobServer(object):
+	"""long-lived worker that imports everything once and then runs
+	classification jobs submitted through a job directory. a job is submitted
+	by writing the path to its parameter file to <dir_job>/<job_id>.job. the
+	server claims the job by renaming that file to <job_id>.run, forks a child
+	to run the job (so each job starts from the already-imported state but
+	can't pollute the server), and writes a json report to <job_id>.done when
+	the job finishes. the output of each job goes to <job_id>.log. while it is
+	running, the server rewrites <dir_job>/heartbeat every second so clients
+	can tell whether it is still alive. the server exits once the file
+	<dir_job>/stop exists."""
+	_interval = 0.05
+	_heartbeat_interval = 1
+	
+	dir_job = None
+	workers = 1
+	
+	_running = None
+	_t_heartbeat = 0
+	
+	def __init__(self, dir_job, workers=1):
+		self.dir_job = dir_job
+		self.workers = max(1, int(workers))
+		
+		self._running = {}
+		
+		if not os.path.isdir(self.dir_job):
+			os.makedirs(self.dir_job)
+	
+	def serve(self):
+		"""process jobs until we are told to stop"""
+		status('serving jobs from %s with %d worker(s)' % (self.dir_job, self.workers))
+		
+		while not os.path.exists(self._get_path('stop')):
+			self._heartbeat()
+			self._reap()
+			
+			job_id = self._claim() if len(self._running) < self.workers else None
+			if job_id is None:
+				time.sleep(self._interval)
+			else:
+				self._start(job_id)
+		
+		#let the running jobs finish
+		while self._running:
+			self._heartbeat()
+			self._reap()
+			time.sleep(self._interval)
+		
+		status('server stopped')
+	
+	def _heartbeat(self):
+		"""let clients know we are still alive"""
+		t = time.time()
+		if t - self._t_heartbeat < self._heartbeat_interval:
+			return
+		
+		path_heartbeat = self._get_path('heartbeat')
+		path_tmp = '%s.tmp' % (path_heartbeat)
+		
+		with open(path_tmp, 'w') as f:
+			f.write('%.3f' % (t))
+		os.rename(path_tmp, path_heartbeat)
+		
+		self._t_heartbeat = t
+	
+	def _get_path(self, job_id, ext=None):
+		"""get the path to a job file"""
+		name = job_id if ext is None else '%s.%s' % (job_id, ext)
+		return os.path.join(self.dir_job, name)
+	
+	def _claim(self):
+		"""claim the oldest submitted job. returns None if there are no jobs.
+		claiming is an atomic rename, so several servers can share a job
+		directory."""
+		path_jobs = glob.glob(self._get_path('*', 'job'))
+		path_jobs.sort(key=lambda path: os.path.getmtime(path) if os.path.exists(path) else np.inf)
+		
+		for path_job in path_jobs:
+			job_id = split_path(path_job)[1]
+			try:
+				os.rename(path_job, self._get_path(job_id, 'run'))
+				return job_id
+			except OSError:  # someone else got it first
+				continue
+		
+		return None
+	
+	def _start(self, job_id):
+		"""fork a child process to run a job"""
+		t_claim = time.time()
+		
+		pid = os.fork()
+		if pid:  # parent
+			self._running[pid] = job_id
+		else:  # child
+			exit_code = 1
+			try:
+				exit_code = self._run_job(job_id, t_claim)
+			finally:
+				os._exit(exit_code)
+	
+	def _run_job(self, job_id, t_claim):
+		"""run a single job. this is called from the child process."""
+		#send the job output to the job's log file
+		sys.stdout.flush()
+		sys.stderr.flush()
+		with open(self._get_path(job_id, 'log'), 'w') as f:
+			os.dup2(f.fileno(), sys.stdout.fileno())
+			os.dup2(f.fileno(), sys.stderr.fileno())
+		
+		t_start = time.time()
+		report = {'job_id': job_id, 'success': False, 'startup': t_start - t_claim}
+		
+		try:
+			with open(self._get_path(job_id, 'run'), 'r') as f:
+				report['path_param'] = f.read().strip()
+			
+			status('job %s started in %.1f ms' % (job_id, 1000*report['startup']))
+			
+			result = run(report['path_param'])
+			
+			report['path_result'] = result.output_path
+			report['success'] = True
+		except Exception:
+			report['error'] = traceback.format_exc()
+			status(report['error'], debug='error')
+		
+		report['time'] = time.time() - t_start
+		
+		sys.stdout.flush()
+		self._finish(job_id, report)
+		
+		return 0 if report['success'] else 1
+	
+	def _finish(self, job_id, report):
+		"""write a job's report and clear its run file"""
+		path_done = self._get_path(job_id, 'done')
+		path_tmp = '%s.tmp' % (path_done)
+		
+		with open(path_tmp, 'w') as f:
+			json.dump(report, f)
+		os.rename(path_tmp, path_done)
+		
+		if os.path.exists(self._get_path(job_id, 'run')):
+			os.remove(self._get_path(job_id, 'run'))
+	
+	def _reap(self, block=False):
+		"""collect finished children"""
+		while self._running:
+			try:
+				pid, exit_status = os.waitpid(-1, 0 if block else os.WNOHANG)
+			except OSError:
+				break
+			
+			if pid == 0:
+				break
+			
+			job_id = self._running.pop(pid, None)
+			if job_id is None:
+				continue
+			
+			#make sure the client hears about jobs that died without reporting
+			if not os.path.exists(self._get_path(job_id, 'done')):
+				self._finish(job_id, {
+					'job_id': job_id,
+					'success': False,
+					'error': 'job process died (status %d)' % (exit_status),
+				})
+			
+			status('job %s finished' % (job_id), debug='all')
+			
+			if block:
+				break
 
-#classify!
-result = classify(param, data, masks)
 
-status('script execution finished!', debug='all')
+if __name__ == '__main__':
+	if len(sys.argv) > 1 and sys.argv[1] == '--server':
+		#python MVPAClassify.py --server <dir_job> [<workers>]
+		assert len(sys.argv) > 2, "The server must be passed the path to a job directory."
+		
+		workers = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+		
+		JobServer(sys.argv[2], workers=workers).serve()
+	else:
+		run(DBG_PATH_PARAM)
@@ -0,0 +1,418 @@
+"""tests for MVPAClassify.py. run with:
+	python -m unittest test_MVPAClassify"""
+import os
+import time
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+
+import numpy as np
+import nibabel as nib
+
+import MVPAClassify as M
+
+
+def make_data(dir_out, seed=0, shape=(6,6,6), targets=('a','b','c'), chunks=4, reps=3):
+	"""make a synthetic dataset with a target signal in part of the volume.
+	returns the data path, mask paths, and attribute path."""
+	rng = np.random.RandomState(seed)
+	
+	target = [t for c in range(chunks) for r in range(reps) for t in targets]
+	chunk = [c+1 for c in range(chunks) for r in range(reps) for t in targets]
+	
+	data = rng.randn(*(shape + (len(target),)))
+	for idx, t in enumerate(target):
+		data[:3,:,:,idx] += 0.8*targets.index(t)
+	
+	path_data = os.path.join(dir_out, 'data.nii.gz')
+	nib.save(nib.Nifti1Image(data.astype(np.float32), np.eye(4)), path_data)
+	
+	path_mask = []
+	for idx, sl in enumerate([np.s_[:3,:,:3], np.s_[2:6,:,:]]):
+		msk = np.zeros(shape, dtype=np.uint8)
+		msk[sl] = 1
+		
+		path_mask.append(os.path.join(dir_out, 'mask%d.nii.gz' % (idx)))
+		nib.save(nib.Nifti1Image(msk, np.eye(4)), path_mask[-1])
+	
+	path_attr = os.path.join(dir_out, 'data.attr')
+	with open(path_attr, 'w') as f:
+		for t, c in zip(target, chunk):
+			f.write('%s %d\n' % (t, c))
+	
+	return path_data, path_mask, path_attr
+
+def make_param(dir_out, **kwargs):
+	"""write a parameter file for the synthetic dataset (with the defaults from
+	MVPAClassify.m) and return its path"""
+	path_data, path_mask, path_attr = make_data(dir_out)
+	
+	param = {
+		'path_data': [path_data], 'path_attribute': path_attr, 'path_mask': path_mask,
+		'mask_name': [], 'dir_out': dir_out, 'name': 'test',
+		'path_param': os.path.join(dir_out, 'test.parameters'),
+		'path_result': os.path.join(dir_out, 'test.mat'), 'path_script': '',
+		'unique_target': ['a','b','c'], 'target_subset': ['a','b','c'], 'target_blank': [],
+		'sample_attr': {}, 'zscore': 'chunks', 'target_balancer': 10,
+		'mask_balancer': 'none', 'mask_balancer_count': 3, 'mask_union': False,
+		'partitioner': 1, 'classifier': 'GNB', 'nested_path': False,
+		'allway': True, 'twoway': True, 'selection': 1, 'save_selected': False,
+		'sensitivities': False, 'mean_control': False, 'average': False,
+		'spatiotemporal': False, 'matchedcrossclassify': False, 'match_features': False,
+		'match_include_blank': True, 'match_incremental': False,
+		'dcclassify': False, 'dcclassify_lags': 1, 'dcclassify_lag_select': 'none',
+		'dcclassify_memmap': False, 'nan_remove': 'none', 'array_to_file': False,
+		'permutations': False, 'permutation_stop': 'none', 'permutation_h': 10,
+		'permutation_alpha': 0.05, 'permutation_confidence': 0.99, 'seed': 0,
+		'checkpoint': True, 'cache_dir': None, 'cache_size': 10240, 'load_slots': 1,
+		'cores': 1, 'result_format': 'mat', 'server': None,
+		'force': True, 'force_each': False, 'run': True, 'error': False,
+		'debug': 'info', 'silent': True,
+		'generated_by': 'test_MVPAClassify', 'creation_time': 'now',
+	}
+	param.update(kwargs)
+	
+	with open(param['path_param'], 'w') as f:
+		json.dump(param, f)
+	
+	return param['path_param']
+
+
+class TempDirTestCase(unittest.TestCase):
+	"""test case with a temporary output directory"""
+	def setUp(self):
+		self.dir_out = tempfile.mkdtemp()
+	
+	def tearDown(self):
+		shutil.rmtree(self.dir_out)
+
+
+class TestCheckpoint(TempDirTestCase):
+	def run_counted(self, path_param, crash_after=None):
+		"""run MVPAClassify, counting the classifications that are actually
+		computed and optionally crashing after some number of them"""
+		count = [0]
+		get_classification_results = M.get_classification_results
+		
+		def counted(*args, **kwargs):
+			if crash_after is not None and count[0] >= crash_after:
+				raise RuntimeError('simulated crash')
+			
+			count[0] += 1
+			return get_classification_results(*args, **kwargs)
+		
+		M.get_classification_results = counted
+		try:
+			M.run(path_param)
+		finally:
+			M.get_classification_results = get_classification_results
+		
+		return count[0]
+	
+	def test_resume_seeded_classifier(self):
+		"""an interrupted run with a seeded classifier picks up where it left
+		off"""
+		path_param = make_param(self.dir_out, classifier='SMLR(lm=10)')
+		
+		#crash after the allway classification of the second mask. that leaves
+		#three twoway classifications to do.
+		self.assertRaises(RuntimeError, self.run_counted, path_param, crash_after=5)
+		self.assertEqual(self.run_counted(path_param), 3)
+	
+	def test_remove_store(self):
+		"""the checkpoint store is kept after a crash and deleted once the run
+		finishes"""
+		path_param = make_param(self.dir_out)
+		path_store = os.path.join(self.dir_out, 'test.checkpoint.sqlite')
+		
+		self.assertRaises(RuntimeError, self.run_counted, path_param, crash_after=5)
+		self.assertTrue(os.path.exists(path_store))
+		
+		self.run_counted(path_param)
+		self.assertFalse(os.path.exists(path_store))
+	
+	def test_force_each(self):
+		"""runs with force_each set don't record checkpoints"""
+		path_param = make_param(self.dir_out, force_each=True)
+		path_store = os.path.join(self.dir_out, 'test.checkpoint.sqlite')
+		
+		self.assertRaises(RuntimeError, self.run_counted, path_param, crash_after=5)
+		self.assertFalse(os.path.exists(path_store))
+
+
+class TestMaskBootstrap(TempDirTestCase):
+	def test_subsets(self):
+		"""each bootstrap's voxel subset survives into the final result"""
+		path_param = make_param(self.dir_out, mask_balancer='bootstrap', mask_balancer_count=2, twoway=False)
+		result = M.run(path_param)
+		
+		#mask1 is bootstrapped down to the size of mask0
+		subset = np.asarray(result['mask1']['mask_bootstrap_subset'])
+		self.assertEqual(subset.shape, (2, 54))
+		self.assertFalse(np.array_equal(np.sort(subset[0]), np.sort(subset[1])))
+		
+		for idx in subset:
+			self.assertEqual(len(np.unique(idx)), 54)
+			self.assertTrue(np.array_equal(idx, np.round(idx)))
+
+
+class TestJobServer(TempDirTestCase):
+	def test_heartbeat(self):
+		"""the server keeps its heartbeat going while it runs a job"""
+		path_param = make_param(self.dir_out, twoway=False)
+		dir_job = os.path.join(self.dir_out, 'job')
+		
+		server = M.JobServer(dir_job)
+		
+		#make the job last a few heartbeats
+		run = M.run
+		def run_slow(path_param):
+			time.sleep(3*server._heartbeat_interval)
+			return run(path_param)
+		
+		pid = os.fork()
+		if pid == 0:
+			try:
+				M.run = run_slow
+				server.serve()
+			finally:
+				os._exit(0)
+		
+		try:
+			with open(server._get_path('test', 'job'), 'w') as f:
+				f.write(path_param)
+			
+			heartbeats = []
+			t_start = time.time()
+			while not os.path.exists(server._get_path('test', 'done')) and time.time() - t_start < 60:
+				if os.path.exists(server._get_path('heartbeat')):
+					with open(server._get_path('heartbeat'), 'r') as f:
+						heartbeat = float(f.read())
+					
+					if not heartbeats or heartbeat != heartbeats[-1]:
+						heartbeats.append(heartbeat)
+				
+				time.sleep(0.05)
+			
+			with open(server._get_path('test', 'done'), 'r') as f:
+				self.assertTrue(json.load(f)['success'])
+			self.assertTrue(len(heartbeats) >= 2)
+			self.assertTrue(np.all(np.diff(heartbeats) > 0))
+		finally:
+			open(server._get_path('stop'), 'w').close()
+			os.waitpid(pid, 0)
+
+
+class TestNestedClassifier(unittest.TestCase):
+	def test_path_selection(self):
+		"""path mode selects the same classifiers as independent fits when one
+		candidate is clearly better"""
+		rng = np.random.RandomState(0)
+		ds = M.Dataset(rng.randn(48, 20), sa={'targets': ['a','b','c']*16, 'chunks': np.repeat(np.arange(4), 12)})
+		ds.samples[:,:5] += 2*np.array([0,1,2]*16)[:,np.newaxis]
+		
+		selected = {}
+		for path in [False, True]:
+			selected[path] = []
+			
+			for pds in M.NFoldPartitioner().generate(ds):
+				clf = M.NestedClassifier([M.SMLR(lm=1000, seed=0), M.SMLR(lm=1, seed=0)], M.NFoldPartitioner(), path=path)
+				self.assertEqual(clf.path, path)
+				
+				M.seed_rngs(0)
+				clf.train(pds[pds.sa.partitions == 1])
+				
+				selected[path].append(clf.best_clf_idx)
+		
+		self.assertEqual(selected[True], selected[False])
+		self.assertEqual(selected[False], [1]*4)
+	
+	def test_warm_smlr(self):
+		"""a cold WarmSMLR matches SMLR, and warm starting one doesn't change
+		how other SMLRs train"""
+		rng = np.random.RandomState(0)
+		ds = M.Dataset(rng.randn(24, 10), sa={'targets': ['a','b','c']*8})
+		ds.samples[:,:3] += 2*np.array([0,1,2]*8)[:,np.newaxis]
+		
+		smlr = M.SMLR(lm=1, seed=0)
+		smlr.train(ds)
+		
+		clf = M.WarmSMLR.from_smlr(smlr)
+		clf.train(ds)
+		np.testing.assert_allclose(clf.weights, smlr.weights)
+		
+		clf.warm = clf.get_weights_all()
+		clf.train(ds)
+		self.assertEqual(clf.params.implementation, smlr.params.implementation)
+		self.assertEqual(list(clf.predict(ds)), list(smlr.predict(ds)))
+		
+		smlr2 = M.SMLR(lm=1, seed=0)
+		smlr2.train(ds)
+		np.testing.assert_allclose(smlr2.weights, smlr.weights)
+
+
+class TestCachedOneWayAnova(unittest.TestCase):
+	def get_dataset(self):
+		"""get a dataset with unequal numbers of each target in each chunk"""
+		rng = np.random.RandomState(0)
+		
+		targets = ['a','b','c']*8 + ['a','b']*4
+		chunks = np.concatenate((np.repeat(np.arange(4), 6), np.repeat(np.arange(4), 2)))
+		
+		return M.Dataset(rng.randn(len(targets), 10), sa={'targets': targets, 'chunks': chunks})
+	
+	def check_folds(self, anova, folds, cached):
+		"""check that the F-scores of each fold match OneWayAnova's, and that
+		they come from the table of sums or the fallback as expected"""
+		f_expected = [M.OneWayAnova()(train).samples for train in folds]
+		
+		#count the fallbacks to the normal calculation
+		fallback = [0]
+		call = M.OneWayAnova._call
+		
+		def call_counted(self, dataset):
+			fallback[0] += 1
+			return call(self, dataset)
+		
+		M.OneWayAnova._call = call_counted
+		try:
+			f = [anova(train).samples for train in folds]
+		finally:
+			M.OneWayAnova._call = call
+		
+		self.assertEqual(fallback[0], 0 if cached else len(folds))
+		for f_fold, f_fold_expected in zip(f, f_expected):
+			np.testing.assert_allclose(f_fold, f_fold_expected)
+	
+	def get_folds(self, ds, partitioner):
+		"""get the training set of each fold"""
+		return [pds[pds.sa.partitions == 1] for pds in partitioner.generate(ds)]
+	
+	def test_folds(self):
+		"""the F-scores of each fold match OneWayAnova's, and the dataset
+		isn't changed"""
+		ds = self.get_dataset()
+		
+		ds_index = M.add_sample_index(ds)
+		self.assertEqual(sorted(ds.sa.keys()), ['chunks', 'targets'])
+		
+		anova = M.CachedOneWayAnova(ds_index)
+		self.check_folds(anova, self.get_folds(ds_index, M.NFoldPartitioner()), True)
+	
+	def test_balanced_folds(self):
+		"""folds with partial chunk/target cells (from the target balancer)
+		get the same F-scores as OneWayAnova"""
+		M.seed_rngs(0)
+		
+		ds_index = M.add_sample_index(self.get_dataset())
+		
+		balancer = M.Balancer(attr='targets', count=3, limit='partitions', apply_selection=True)
+		partitioner = M.ChainNode([M.NFoldPartitioner(), balancer], space='partitions')
+		folds = self.get_folds(ds_index, partitioner)
+		
+		anova = M.CachedOneWayAnova(ds_index)
+		self.check_folds(anova, folds, True)
+		
+		#make sure some of the folds do have partial cells
+		table = M.TargetTable(ds_index)
+		count_full = np.bincount(table.chunk_idx*3 + table.target_idx)
+		partial = False
+		for train in folds:
+			table_train = M.TargetTable(train)
+			count = np.bincount(table_train.chunk_idx*3 + table_train.target_idx)
+			partial |= np.any((count > 0) & (count < count_full[:len(count)]))
+		self.assertTrue(partial)
+	
+	def test_permuted_targets(self):
+		"""folds with permuted targets fall back to OneWayAnova"""
+		rng = np.random.RandomState(0)
+		
+		ds_index = M.add_sample_index(self.get_dataset())
+		
+		folds = self.get_folds(ds_index, M.NFoldPartitioner())
+		for train in folds:
+			train.sa['targets'] = rng.permutation(train.targets)
+		
+		anova = M.CachedOneWayAnova(ds_index)
+		self.check_folds(anova, folds, False)
+
+class TestPermutation(unittest.TestCase):
+	def test_gnb_permutation_accuracy(self):
+		"""the vectorized GNB permutations match PyMVPA's GNB on the same folds
+		and seeds"""
+		rng = np.random.RandomState(0)
+		
+		targets = ['a','b','c']*8 + ['a','b']*4
+		chunks = np.concatenate((np.repeat(np.arange(4), 6), np.repeat(np.arange(4), 2)))
+		ds = M.Dataset(rng.randn(len(targets), 10), sa={'targets': targets, 'chunks': chunks})
+		ds.samples[:,:3] += np.array([{'a': 0, 'b': 1, 'c': 2}[t] for t in targets])[:,np.newaxis]
+		
+		M.seed_rngs(0)
+		balancer = M.Balancer(attr='targets', count=2, limit='partitions', apply_selection=True)
+		partitioners = [
+			M.NFoldPartitioner(),
+			M.ChainNode([M.NFoldPartitioner(), balancer], space='partitions'),
+			]
+		
+		clfs = [
+			M.GNB(),
+			M.GNB(common_variance=True),
+			M.GNB(prior='uniform'),
+			M.GNB(prior='ratio'),
+			]
+		
+		seeds = rng.randint(np.iinfo(np.int32).max, size=50)
+		
+		for partitioner in partitioners:
+			folds = M.get_folds(partitioner, ds)
+			
+			for clf in clfs:
+				np.testing.assert_allclose(
+					M.gnb_permutation_accuracy(clf, folds, seeds),
+					M.permutation_accuracy(clf, folds, seeds),
+					)
+
+
+class TestSemaphore(unittest.TestCase):
+	def test_wait_any_slot(self):
+		"""a waiter takes whichever slot is released, while the other slot
+		stays busy"""
+		for slot_release in range(2):
+			self.check_wait(slot_release)
+	
+	def check_wait(self, slot_release):
+		"""fill both slots of a semaphore, release one, and check that a
+		waiter gets it"""
+		name = 'test_MVPAClassify_%d' % (os.getpid())
+		
+		holders = [M.Semaphore(name, slots=2) for slot in range(2)]
+		for holder in holders:
+			holder.acquire()
+		
+		holder_release = [h for h in holders if h._file.name == h._get_path(slot_release)][0]
+		holder_keep = [h for h in holders if h is not holder_release][0]
+		
+		waiter = M.Semaphore(name, slots=2)
+		thread = threading.Thread(target=waiter.acquire)
+		thread.daemon = True
+		thread.start()
+		
+		try:
+			time.sleep(0.1)
+			holder_release.release()
+			
+			thread.join(2)
+			self.assertFalse(thread.is_alive())
+			self.assertEqual(waiter._file.name, waiter._get_path(slot_release))
+		finally:
+			holder_keep.release()
+			thread.join()
+			waiter.release()
+			
+			for slot in range(2):
+				os.remove(waiter._get_path(slot))
+
+if __name__ == '__main__':
+	unittest.main()